@@ -0,0 +1,377 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Times the addon's hot paths outside Kodi, against synthetic catalogs, local folder trees and a local HTTP
+# server standing in for Apple. Run from the repository root:
+#
+#   python3 benchmarks/run.py
+#   python3 benchmarks/run.py --catalog-sizes 100,1000,10000 --library-sizes 1000,50000 --json results.json
+#
+# Every run works in a scratch folder and leaves the repository untouched
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+repository_path = os.path.dirname(benchmarks_path)
+sys.path[:0] = [os.path.join(benchmarks_path, "stubs"), benchmarks_path, repository_path]
+
+import xbmcaddon  # noqa: E402
+import xbmcvfs  # noqa: E402
+
+from server import BenchmarkServer  # noqa: E402
+import synthetic  # noqa: E402
+
+# Set up by main() before the addon's modules are imported, they resolve the addon folders at import time
+scratch_path = None
+addon_path = None
+profile_path = None
+results = []
+
+
+def report(name, parameter, seconds, rate=""):
+    results.append({"benchmark": name, "parameter": parameter, "seconds": seconds, "rate": rate})
+    print("{:<44} {:>14} {:>11.4f}s {:>16}".format(name, parameter, seconds, rate))
+
+
+# Best time of repeat runs of function, each one after setup. Returns (seconds, result of the last run)
+def timed(function, setup=None, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def reset_settings(**settings):
+    from resources.lib.settings import invalidate_settings
+    for setting_id, value in settings.items():
+        xbmcaddon.set_setting(setting_id.replace("_", "-"), value)
+    invalidate_settings()
+
+
+def write_entries(asset_count, base_url):
+    from resources.lib.settings import known_locations
+    entries = synthetic.entries_json(asset_count, base_url, known_locations)
+    with open(os.path.join(addon_path, "resources", "entries.json"), "w") as f:
+        f.write(json.dumps(entries))
+    return entries
+
+
+def forget_catalog(compiled=False):
+    from resources.lib import catalog
+    catalog._loaded_catalog = None
+    if compiled and os.path.exists(catalog.compiled_catalog_path):
+        os.remove(catalog.compiled_catalog_path)
+
+
+def bench_catalog(server, sizes, repeat):
+    from resources.lib.catalog import load_catalog
+    for size in sizes:
+        write_entries(size, server.base_url)
+        seconds, _ = timed(load_catalog, lambda: forget_catalog(compiled=True), repeat)
+        report("catalog: parse entries.json", size, seconds)
+        seconds, _ = timed(load_catalog, forget_catalog, repeat)
+        report("catalog: load compiled pickle", size, seconds)
+        seconds, _ = timed(load_catalog, repeat=repeat)
+        report("catalog: process cache", size, seconds)
+
+
+def bench_playlist(server, sizes, repeat):
+    from resources.lib.playlist import AtvPlaylist
+    download_folder = os.path.join(scratch_path, "downloads")
+    for size in sizes:
+        entries = write_entries(size, server.base_url)
+        # A tenth of the catalog is downloaded
+        shutil.rmtree(download_folder, ignore_errors=True)
+        os.makedirs(download_folder)
+        for asset in entries["assets"][::10]:
+            open(os.path.join(download_folder, asset["url-1080-H264"].split("/")[-1]), "wb").close()
+        reset_settings(download_folder=download_folder, extra_local_folder="", time_of_day=0)
+        forget_catalog(compiled=True)
+        seconds, _ = timed(lambda: AtvPlaylist(refresh_feed=False), repeat=1)
+        report("AtvPlaylist(): cold catalog", size, seconds)
+        seconds, playlist = timed(lambda: AtvPlaylist(refresh_feed=False), forget_catalog, repeat)
+        report("AtvPlaylist(): compiled catalog", size, seconds)
+        seconds, videos = timed(lambda: AtvPlaylist(refresh_feed=False).compute_playlist_array(), repeat=repeat)
+        report("compute_playlist_array", size, seconds, "{} videos".format(len(videos or ())))
+        reset_settings(time_of_day=3)
+        seconds, videos = timed(lambda: AtvPlaylist(refresh_feed=False).compute_playlist_array(), repeat=repeat)
+        report("compute_playlist_array: time of day", size, seconds, "{} videos".format(len(videos or ())))
+        reset_settings(time_of_day=0)
+        seconds, _ = timed(lambda: [videos.next_video() for _ in range(1000)], repeat=repeat)
+        report("next_video x1000", size, seconds)
+
+
+def bench_scan(sizes, repeat):
+    from resources.lib import localfolder
+    from resources.lib.localfolder import LocalFolderIndex
+    from resources.lib.playlist import AtvPlaylist
+
+    # A scan as the playlist runs it: bring the stored index up to date and save it. Returns every video
+    def scan(library):
+        local_index = LocalFolderIndex(library)
+        for _ in local_index.scan():
+            pass
+        local_index.save()
+        return list(local_index.videos())
+
+    for size in sizes:
+        library = os.path.join(scratch_path, "library{}".format(size))
+        directories = synthetic.make_tree(library, size)
+        reset_settings(extra_local_folder=library, only_extra_local_folder=True)
+
+        def forget_index():
+            if os.path.exists(localfolder.local_folder_index_path):
+                os.remove(localfolder.local_folder_index_path)
+
+        seconds, videos = timed(lambda: scan(library), forget_index, repeat)
+        report("LocalFolderIndex.scan: cold", size, seconds, "{} videos".format(len(videos)))
+        seconds, _ = timed(lambda: scan(library), repeat=repeat)
+        report("LocalFolderIndex.scan: unchanged", size, seconds)
+
+        def change_one_directory():
+            # Directory mtimes have a one second resolution
+            time.sleep(1.1)
+            open(os.path.join(directories[-1], "new{}.mp4".format(time.time())), "wb").close()
+
+        seconds, _ = timed(lambda: scan(library), change_one_directory, repeat)
+        report("LocalFolderIndex.scan: one changed", size, seconds)
+        seconds, videos = timed(lambda: AtvPlaylist(refresh_feed=False, wait_for_scan=True).compute_playlist_array(),
+                                repeat=repeat)
+        report("compute_playlist_array: local only", size, seconds, "{} videos".format(len(videos or ())))
+        reset_settings(extra_local_folder="", only_extra_local_folder=False)
+
+
+def bench_feed(server, sizes, repeat):
+    from resources.lib import feed
+    feed.apple_resources_tar_url = server.base_url + "/resources.tar"
+    for size in sizes:
+        server.set_tar(synthetic.resources_tar(synthetic.entries_json(size, server.base_url, ["Synthetic"])))
+
+        def forget_validators():
+            if os.path.exists(feed.feed_state_path):
+                os.remove(feed.feed_state_path)
+
+        seconds, _ = timed(lambda: feed.get_latest_entries_from_apple(force=True), forget_validators, repeat)
+        report("feed: download and extract", size, seconds)
+        seconds, _ = timed(lambda: feed.get_latest_entries_from_apple(force=True), repeat=repeat)
+        report("feed: not modified", size, seconds)
+
+
+def bench_download(server, file_count, file_size, connection_counts):
+    from resources.lib import verification
+    from resources.lib.downloader import Downloader
+    names = ["comp_DOWNLOAD{:04d}_SDR_2K_AVC.mov".format(index) for index in range(file_count)]
+    server.blobs.update({name: file_size for name in names})
+    with open(os.path.join(addon_path, "resources", "checksums.json"), "w") as f:
+        f.write(json.dumps({name: synthetic.blob_md5(name, file_size) for name in names}))
+    urls = [server.base_url + "/Videos/" + name for name in names]
+    download_folder = os.path.join(scratch_path, "offline")
+    total_mb = file_count * file_size / 1024 / 1024
+    label = "{}x{}MB".format(file_count, file_size // 1024 // 1024)
+
+    for connections in connection_counts:
+        shutil.rmtree(download_folder, ignore_errors=True)
+        os.makedirs(download_folder)
+        if os.path.exists(verification.verification_index_path):
+            os.remove(verification.verification_index_path)
+        reset_settings(download_folder=download_folder, enable_checksums=True, deep_verify=False,
+                       download_connections=connections)
+        seconds, _ = timed(lambda: Downloader().download_videos_from_urls(urls), repeat=1)
+        report("Downloader: {} connections".format(connections), label, seconds,
+               "{:.1f} MB/s".format(total_mb / seconds))
+        downloaded = sum(os.path.getsize(os.path.join(download_folder, name)) for name in os.listdir(download_folder))
+        if downloaded != file_count * file_size:
+            print("Downloader: only {} of {} bytes were downloaded".format(downloaded, file_count * file_size))
+
+    seconds, _ = timed(lambda: Downloader().download_videos_from_urls(urls), repeat=1)
+    report("Downloader: all verified", label, seconds)
+    reset_settings(deep_verify=True)
+    seconds, _ = timed(lambda: Downloader().download_videos_from_urls(urls), repeat=1)
+    report("Downloader: deep verify", label, seconds, "{:.1f} MB/s".format(total_mb / seconds))
+    reset_settings(deep_verify=False)
+
+
+def bench_checksum(file_size, repeat):
+    from resources.lib.hashing import md5_of_file
+    path = os.path.join(scratch_path, "checksum.mov")
+    with open(path, "wb") as f:
+        for chunk in synthetic.blob_chunks("checksum", 0, file_size):
+            f.write(chunk)
+    seconds, _ = timed(lambda: md5_of_file(path), repeat=repeat)
+    report("md5_of_file", "{}MB".format(file_size // 1024 // 1024), seconds,
+           "{:.1f} MB/s".format(file_size / 1024 / 1024 / seconds))
+
+
+# The standalone checksum generator, hashing every rendition of the feed straight from the server
+def bench_generator(server, asset_count, file_size, worker_counts):
+    import entrychecksumgenerator
+    entries = synthetic.entries_json(asset_count, server.base_url, ["Generator"])
+    expected = {}
+    qualities = {}
+    for asset in entries["assets"]:
+        for key in synthetic.renditions:
+            name = asset[key].split("/")[-1]
+            server.blobs[name] = file_size
+            expected[name] = synthetic.blob_md5(name, file_size)
+            qualities[name] = key
+    feed_path = os.path.join(scratch_path, "generator-entries.json")
+    checksums_path = os.path.join(scratch_path, "generator-checksums.json")
+    state_path = os.path.join(scratch_path, "generator-state.json")
+    validators_path = os.path.join(scratch_path, "generator-validators.json")
+    with open(feed_path, "w") as f:
+        f.write(json.dumps(entries))
+    total_mb = len(expected) * file_size / 1024 / 1024
+    label = "{}x{}MB".format(len(expected), file_size // 1024 // 1024)
+
+    def generate(workers, incremental=False):
+        # The generator prints every file it processes
+        with contextlib.redirect_stdout(io.StringIO()):
+            entrychecksumgenerator.generate_entries_and_checksums(workers, feed_path, checksums_path, state_path,
+                                                                  validators_path, incremental)
+        with open(checksums_path) as f:
+            if json.loads(f.read()) != expected:
+                print("Checksum generator: the checksums don't match the served files")
+
+    for workers in worker_counts:
+        seconds, _ = timed(lambda: generate(workers), repeat=1)
+        report("Checksum generator: {} workers".format(workers), label, seconds,
+               "{:.1f} MB/s".format(total_mb / seconds))
+
+    # Resume a run interrupted after half of the files
+    def interrupt():
+        with open(state_path, "w") as f:
+            f.write(json.dumps({name: {"checksum": checksum, "size": file_size, "quality": qualities[name]}
+                                for name, checksum in list(expected.items())[:len(expected) // 2]}))
+    seconds, _ = timed(lambda: generate(worker_counts[-1]), setup=interrupt, repeat=1)
+    report("Checksum generator: resume half", label, seconds)
+
+    seconds, _ = timed(lambda: generate(worker_counts[-1], incremental=True), repeat=1)
+    report("Checksum generator: incremental, no change", label, seconds)
+
+    # One more scene in the feed, and one video that changed
+    entries = synthetic.entries_json(asset_count + 1, server.base_url, ["Generator"])
+    for key in synthetic.renditions:
+        name = entries["assets"][-1][key].split("/")[-1]
+        server.blobs[name] = file_size
+        expected[name] = synthetic.blob_md5(name, file_size)
+    changed_name = entries["assets"][0]["url-1080-H264"].split("/")[-1]
+    server.blobs[changed_name] = file_size // 2
+    expected[changed_name] = synthetic.blob_md5(changed_name, file_size // 2)
+    with open(feed_path, "w") as f:
+        f.write(json.dumps(entries))
+    seconds, _ = timed(lambda: generate(worker_counts[-1], incremental=True), repeat=1)
+    report("Checksum generator: incremental, 6 changed", label, seconds)
+
+
+# The size and availability report of the standalone checksum generator, HEAD requests only
+def bench_report(server, sizes):
+    import entrychecksumgenerator
+    from resources.lib.settings import known_locations
+    for size in sizes:
+        entries = synthetic.entries_json(size, server.base_url, known_locations)
+        expected = {}
+        for asset in entries["assets"]:
+            for key in synthetic.renditions:
+                name = asset[key].split("/")[-1]
+                server.blobs[name] = expected[name] = len(name) * 1024 * 1024
+        feed_path = os.path.join(scratch_path, "report-entries.json")
+        sizes_path = os.path.join(scratch_path, "report-sizes.json")
+        with open(feed_path, "w") as f:
+            f.write(json.dumps(entries))
+
+        def report_sizes(workers):
+            # The report prints its tables
+            with contextlib.redirect_stdout(io.StringIO()):
+                entrychecksumgenerator.report_sizes_and_availability(workers, feed_path, sizes_path)
+            with open(sizes_path) as f:
+                if json.loads(f.read()) != expected:
+                    print("Size report: the sizes don't match the served files")
+
+        for workers in (1, entrychecksumgenerator.report_workers):
+            seconds, _ = timed(lambda: report_sizes(workers), repeat=1)
+            report("Size report: {} workers".format(workers), "{} videos".format(len(expected)), seconds,
+                   "{:.0f} videos/s".format(len(expected) / seconds))
+
+
+def main():
+    global scratch_path, addon_path, profile_path
+
+    def sizes(value):
+        return [int(size) for size in value.split(",") if size]
+
+    parser = argparse.ArgumentParser(description="Benchmark the screensaver.atv4 hot paths outside Kodi")
+    parser.add_argument("--catalog-sizes", type=sizes, default=[100, 1000, 10000],
+                        help="assets in the synthetic entries.json (default: 100,1000,10000)")
+    parser.add_argument("--library-sizes", type=sizes, default=[1000, 20000],
+                        help="videos in the synthetic local folder (default: 1000,20000)")
+    parser.add_argument("--download-files", type=int, default=4, help="files to download (default: 4)")
+    parser.add_argument("--download-size", type=int, default=64, help="size of each file in MB (default: 64)")
+    parser.add_argument("--connections", type=sizes, default=[1, 4],
+                        help="download connections to compare (default: 1,4)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each timing, the best is kept (default: 3)")
+    parser.add_argument("--only", default="", help="comma separated benchmarks to run: catalog, playlist, scan, "
+                                                   "feed, download, checksum, generator, report (default: all)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    selected = set(args.only.split(",")) if args.only else {"catalog", "playlist", "scan", "feed", "download",
+                                                             "checksum", "generator", "report"}
+
+    scratch_path = tempfile.mkdtemp(prefix="atv4-benchmark-")
+    addon_path = os.path.join(scratch_path, "addon")
+    profile_path = os.path.join(scratch_path, "profile")
+    os.makedirs(os.path.join(addon_path, "resources"))
+    os.makedirs(profile_path)
+    shutil.copy(os.path.join(repository_path, "resources", "checksums.json"), os.path.join(addon_path, "resources"))
+    xbmcaddon.addon_info.update({"path": addon_path, "profile": "special://profile/"})
+    xbmcvfs.special_paths["special://profile/"] = profile_path + os.sep
+
+    server = BenchmarkServer()
+    try:
+        print("{:<44} {:>14} {:>12} {:>16}".format("benchmark", "size", "time", "rate"))
+        if "catalog" in selected:
+            bench_catalog(server, args.catalog_sizes, args.repeat)
+        if "playlist" in selected:
+            bench_playlist(server, args.catalog_sizes, args.repeat)
+        if "scan" in selected:
+            bench_scan(args.library_sizes, args.repeat)
+        if "feed" in selected:
+            bench_feed(server, args.catalog_sizes, args.repeat)
+        if "download" in selected:
+            bench_download(server, args.download_files, args.download_size * 1024 * 1024, args.connections)
+        if "checksum" in selected:
+            bench_checksum(args.download_size * 1024 * 1024, args.repeat)
+        if "generator" in selected:
+            bench_generator(server, args.download_files, args.download_size * 1024 * 1024 // len(synthetic.renditions),
+                            args.connections)
+        if "report" in selected:
+            bench_report(server, args.catalog_sizes)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
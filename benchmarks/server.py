@@ -0,0 +1,95 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Local HTTP server standing in for sylvan.apple.com: serves a synthetic resources.tar and video blobs of any
+# size, with HEAD, Range, ETag and If-None-Match support like Apple's CDN
+
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic import blob_chunks
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resource(self):
+        # /resources.tar, or /Videos/<name> with the size of each blob set on the server
+        if self.path == "/resources.tar":
+            return "tar", len(self.server.tar)
+        match = re.match(r"^/(?:.*/)?Videos/([^/]+)$", self.path)
+        if match and match.group(1) in self.server.blobs:
+            return match.group(1), self.server.blobs[match.group(1)]
+        return None, 0
+
+    def _headers(self):
+        name, size = self._resource()
+        if name is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        etag = '"{}-{}"'.format(self.server.generation, size)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        start, end = 0, size
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and name != "tar":
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return name, start, end
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        response = self._headers()
+        if response is None:
+            return
+        name, start, end = response
+        if name == "tar":
+            self.wfile.write(self.server.tar[start:end])
+            return
+        for chunk in blob_chunks(name, start, end):
+            self.wfile.write(chunk)
+
+
+class BenchmarkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.tar = b""
+        # {file name: size}
+        self.blobs = {}
+        # Changes the ETag whenever the tar is replaced
+        self.generation = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def set_tar(self, tar):
+        self.tar = tar
+        self.generation += 1
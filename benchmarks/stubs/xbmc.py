@@ -0,0 +1,133 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Stand-in for Kodi's xbmc module, covering what the addon uses, so the benchmarks run outside Kodi
+
+import json
+import time
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGWARNING = 2
+LOGERROR = 3
+LOGFATAL = 4
+LOGNONE = 5
+
+PLAYLIST_MUSIC = 0
+PLAYLIST_VIDEO = 1
+
+# Messages at or above this level are printed, the benchmarks only want to hear about problems
+log_level = LOGWARNING
+
+# Answers to getCondVisibility, anything else is False
+conditions = {}
+
+# Seconds since the last user input
+idle_time = 0
+
+
+def log(msg, level=LOGDEBUG):
+    if level >= log_level:
+        print("[xbmc] {}".format(msg))
+
+
+def sleep(milliseconds):
+    time.sleep(milliseconds / 1000)
+
+
+def getCondVisibility(condition):
+    return conditions.get(condition, False)
+
+
+def getGlobalIdleTime():
+    return idle_time
+
+
+def executebuiltin(function, wait=False):
+    pass
+
+
+def executeJSONRPC(request):
+    request = json.loads(request)
+    # Kodi's power saving settings are off
+    return json.dumps({"id": request.get("id"), "jsonrpc": "2.0", "result": {"value": 0}})
+
+
+def getInfoLabel(label):
+    return ""
+
+
+class Monitor:
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=None):
+        if timeout:
+            time.sleep(timeout)
+        return False
+
+    def onSettingsChanged(self):
+        pass
+
+
+class Player:
+    def __init__(self):
+        self.playing = None
+
+    def play(self, item=None, listitem=None, windowed=False, startpos=-1):
+        self.playing = item
+
+    def stop(self):
+        self.playing = None
+
+    def pause(self):
+        pass
+
+    def playnext(self):
+        pass
+
+    def isPlaying(self):
+        return self.playing is not None
+
+    def isPlayingVideo(self):
+        return self.playing is not None
+
+    def getTotalTime(self):
+        return 0.0
+
+    def getTime(self):
+        return 0.0
+
+    def seekTime(self, seconds):
+        pass
+
+
+class PlayList:
+    def __init__(self, playlist):
+        self.items = []
+        self.position = -1
+
+    def add(self, url, listitem=None, index=-1):
+        self.items.append((url, listitem))
+
+    def clear(self):
+        self.items = []
+        self.position = -1
+
+    def size(self):
+        return len(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        url, listitem = self.items[index]
+        return listitem
+
+    def getposition(self):
+        return self.position
@@ -0,0 +1,89 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Stand-in for Kodi's xbmcaddon module. Settings start from the defaults in resources/settings.xml and can be
+# overridden with set_setting(), strings come from the en_gb strings.po
+
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+repository_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# What getAddonInfo returns, "path" and "profile" are pointed at scratch folders by the benchmark runner
+addon_info = {
+    "id": "screensaver.atv4",
+    "name": "Aerial",
+    "version": "0",
+    "path": repository_path,
+    "profile": os.path.join(repository_path, "benchmarks", "profile"),
+    "icon": os.path.join(repository_path, "icon.png"),
+}
+
+
+def _default_settings():
+    settings = {}
+    tree = ElementTree.parse(os.path.join(repository_path, "resources", "settings.xml"))
+    for setting in tree.iter("setting"):
+        default = setting.find("default")
+        settings[setting.get("id")] = default.text if default is not None and default.text else ""
+    return settings
+
+
+def _strings():
+    strings = {}
+    path = os.path.join(repository_path, "resources", "language", "resource.language.en_gb", "strings.po")
+    with open(path, encoding="utf-8") as f:
+        for string_id, text in re.findall(r'msgctxt "#(\d+)"\s*msgid "(.*)"', f.read()):
+            strings[int(string_id)] = text
+    return strings
+
+
+_settings = _default_settings()
+_localized = _strings()
+
+
+def set_setting(setting_id, value):
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    _settings[setting_id] = str(value)
+
+
+class Addon:
+    def __init__(self, id=None):
+        pass
+
+    def getAddonInfo(self, key):
+        return addon_info.get(key, "")
+
+    def getLocalizedString(self, string_id):
+        return _localized.get(string_id, "")
+
+    def getSetting(self, setting_id):
+        return _settings.get(setting_id, "")
+
+    def getSettingBool(self, setting_id):
+        return _settings.get(setting_id, "") == "true"
+
+    def getSettingInt(self, setting_id):
+        return int(_settings.get(setting_id) or 0)
+
+    def getSettingString(self, setting_id):
+        return _settings.get(setting_id, "")
+
+    def setSetting(self, setting_id, value):
+        set_setting(setting_id, value)
+
+    def setSettingBool(self, setting_id, value):
+        set_setting(setting_id, value)
+
+    def setSettingInt(self, setting_id, value):
+        set_setting(setting_id, value)
+
+    def openSettings(self):
+        pass
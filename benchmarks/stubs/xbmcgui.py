@@ -0,0 +1,87 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Stand-in for Kodi's xbmcgui module: dialogs answer like a user accepting the defaults, windows do nothing
+
+
+class Dialog:
+    def notification(self, heading, message, icon="", time=5000, sound=True):
+        pass
+
+    def ok(self, heading, message):
+        return True
+
+    def yesno(self, heading, message, nolabel="", yeslabel="", autoclose=0):
+        return True
+
+    def select(self, heading, options, autoclose=0, preselect=-1, useDetails=False):
+        return 0
+
+    def multiselect(self, heading, options, autoclose=0, preselect=None, useDetails=False):
+        return list(range(len(options)))
+
+
+class DialogProgress:
+    def create(self, heading, message=""):
+        pass
+
+    def update(self, percent, message=""):
+        pass
+
+    def iscanceled(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ListItem:
+    def __init__(self, label="", label2="", path="", offscreen=False):
+        self.path = path
+        self.properties = {}
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def getProperty(self, key):
+        return self.properties.get(key, "")
+
+    def getPath(self):
+        return self.path
+
+
+class Control:
+    def setLabel(self, label):
+        pass
+
+    def setVisible(self, visible):
+        pass
+
+
+class WindowXML:
+    def __init__(self, xmlFilename, scriptPath, defaultSkin="Default", defaultRes="720p", isMedia=False):
+        self.properties = {}
+
+    def getControl(self, control_id):
+        return Control()
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def doModal(self):
+        pass
+
+    def show(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class WindowXMLDialog(WindowXML):
+    pass
@@ -0,0 +1,120 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Stand-in for Kodi's xbmcvfs module on top of the local filesystem. Like Kodi, exists() only reports
+# directories when the path ends with a separator, and File opened for writing always truncates
+
+import os
+import shutil
+
+# Where special://profile/ and special://home/ point, set by the benchmark runner
+special_paths = {}
+
+
+def translatePath(path):
+    for prefix, target in special_paths.items():
+        if path.startswith(prefix):
+            return os.path.join(target, path[len(prefix):])
+    return path
+
+
+def exists(path):
+    path = translatePath(path)
+    if path.endswith(("/", "\\")):
+        return os.path.isdir(path)
+    return os.path.exists(path)
+
+
+def listdir(path):
+    dirs, files = [], []
+    with os.scandir(translatePath(path)) as entries:
+        for entry in entries:
+            (dirs if entry.is_dir() else files).append(entry.name)
+    return dirs, files
+
+
+def mkdir(path):
+    os.makedirs(translatePath(path), exist_ok=True)
+    return True
+
+
+def mkdirs(path):
+    return mkdir(path)
+
+
+def delete(path):
+    try:
+        os.remove(translatePath(path))
+        return True
+    except OSError:
+        return False
+
+
+def rename(source, target):
+    try:
+        os.replace(translatePath(source), translatePath(target))
+        return True
+    except OSError:
+        return False
+
+
+def copy(source, target):
+    shutil.copyfile(translatePath(source), translatePath(target))
+    return True
+
+
+def rmdir(path, force=False):
+    if force:
+        shutil.rmtree(translatePath(path), ignore_errors=True)
+    else:
+        os.rmdir(translatePath(path))
+    return True
+
+
+class Stat:
+    def __init__(self, path):
+        self._stat = os.stat(translatePath(path))
+
+    def st_size(self):
+        return self._stat.st_size
+
+    def st_mtime(self):
+        return int(self._stat.st_mtime)
+
+
+class File:
+    def __init__(self, path, mode="r"):
+        self._file = open(translatePath(path), "wb" if "w" in mode else "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=0):
+        return self._file.read(size if size > 0 else -1).decode("utf-8", "ignore")
+
+    def readBytes(self, size=0):
+        return bytearray(self._file.read(size if size > 0 else -1))
+
+    def write(self, buffer):
+        self._file.write(buffer)
+        return True
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        self._file.close()
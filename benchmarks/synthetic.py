@@ -0,0 +1,105 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# Synthetic inputs of any size: an entries.json catalog, video blobs and local folder trees
+
+import hashlib
+import io
+import json
+import os
+import random
+import tarfile
+
+# Quality keys of entries.json and the suffix Apple gives each rendition's file name
+renditions = {
+    "url-1080-H264": "SDR_2K_AVC",
+    "url-1080-SDR": "SDR_2K_HEVC",
+    "url-1080-HDR": "HDR_2K_HEVC",
+    "url-4K-SDR": "SDR_4K_HEVC",
+    "url-4K-HDR": "HDR_4K_HEVC",
+}
+categories = ["Space", "Cities", "Underwater", "Landscapes"]
+# Blobs repeat a block of pseudo random bytes, generated once per blob name
+blob_block_size = 64 * 1024
+
+
+def entries_json(asset_count, base_url, locations):
+    rng = random.Random(asset_count)
+    category_ids = {name: "{:08X}-0000-0000-0000-{:012X}".format(index, index) for index, name in
+                    enumerate(categories)}
+    assets = []
+    for index in range(asset_count):
+        location = locations[index % len(locations)]
+        shot_id = "SYN{:05d}_{}".format(index, location.upper().replace(" ", "_"))
+        asset = {
+            "accessibilityLabel": location,
+            "categories": [category_ids[rng.choice(categories)]],
+            "id": "{:032X}".format(index),
+            "shotID": shot_id,
+            "pointsOfInterest": {str(offset): "{}_{}".format(shot_id, offset) for offset in (0, 60, 120, 180)},
+        }
+        for key, suffix in renditions.items():
+            asset[key] = "{}/Videos/comp_{}_{}.mov".format(base_url, shot_id, suffix)
+        assets.append(asset)
+    return {
+        "assets": assets,
+        "categories": [{"id": category_id, "localizedNameKey": "AerialCategory" + name}
+                       for name, category_id in category_ids.items()],
+        "initialAssetCount": asset_count,
+        "version": 1,
+    }
+
+
+# The resources.tar Apple serves, holding entries.json
+def resources_tar(entries):
+    data = json.dumps(entries).encode("utf-8")
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("entries.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _blob_block(name):
+    return random.Random(name).randbytes(blob_block_size)
+
+
+# The bytes of blob name from start to end, in chunks
+def blob_chunks(name, start, end, chunk_size=blob_block_size):
+    block = _blob_block(name)
+    position = start
+    while position < end:
+        offset = position % blob_block_size
+        chunk = block[offset:offset + min(chunk_size, end - position)]
+        yield chunk
+        position += len(chunk)
+
+
+def blob_md5(name, size):
+    digest = hashlib.md5()
+    for chunk in blob_chunks(name, 0, size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Write file_count videos (and a few other files) under root, fanout sub directories per level down to depth
+def make_tree(root, file_count, depth=3, fanout=6):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, "dir{}".format(index)) for parent in level for index in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    for index in range(file_count):
+        directory = directories[index % len(directories)]
+        open(os.path.join(directory, "video{:06d}.mp4".format(index)), "wb").close()
+        if index % 10 == 0:
+            open(os.path.join(directory, "notes{:06d}.txt".format(index)), "wb").close()
+    return directories
@@ -6,20 +6,41 @@
    See LICENSE for more information.
 
    Note: This is a standalone script to update the offline video entries and
-   their checksums. Extra modes allow for Apple JSON download and simple
-   printing of the different locations available in the JSON.
+   their checksums. Extra modes allow for Apple JSON download, simple
+   printing of the different locations available in the JSON and a size and
+   availability report of the videos.
 """
 import hashlib
+import http.client
 import json
 import os
 import sys
 import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib import request
+from urllib.parse import urljoin, urlsplit
 
 apple_local_feed = os.path.join("resources", "entries.json")
-tmp_folder = "tmpvideos"
+local_checksums = os.path.join("resources", "checksums.json")
+# Progress of a checksum run, so an interrupted run can resume
+checksum_state_file = "checksums.partial.json"
+# Size and ETag of every video when it was last hashed, lets an incremental run tell which videos changed
+local_validators = "checksums.validators.json"
+# Videos downloaded and hashed at once, can be changed with a second argument
+checksum_workers = 4
+# Tries per video before giving up on it for this run
+download_attempts = 3
+# Sizes of the videos from the last report, read by the addon to show how much disk a download needs
+local_sizes = os.path.join("resources", "sizes.json")
+# HEAD requests made at once by the report, they are cheap so more than the downloads
+report_workers = 16
+# Redirects followed by a HEAD request before giving up on the video
+max_redirects = 3
 apple_resources_tar = "https://sylvan.apple.com/Aerials/resources-15.tar"
 local_tar = "resources.tar"
+# Amount of data fed to the hash at a time, keeps memory use flat whatever the size of the video
+hash_block_size = 1024 * 1024
 
 
 # Fetch the TAR file containing the latest entries.json and overwrite the local copy
@@ -35,92 +56,262 @@ def get_latest_entries_from_apple():
     os.remove(local_tar)
 
 
-def generate_entries_and_checksums():
-    with open(apple_local_feed) as feed_file:
+# Every URL key Apple uses, one per quality level
+quality_keys = ["url-1080-H264", "url-1080-SDR", "url-1080-HDR", "url-4K-SDR", "url-4K-HDR"]
 
-        print("Starting checksum generator...")
-        # Create the local directory we'll temporarily store videos for checksumming
-        if not os.path.exists(tmp_folder):
-            os.mkdir(tmp_folder)
-        # Dictionary to store the filenames and checksum for each
-        checksums = {}
-        # Dictionary to store the quality levels and the size in megabytes for each
-        # Within each scene, there may be: H264/HEVC, 1080p/4K, SDR/HDR
-        quality_total_size_megabytes = {"url-1080-H264": 0,
-                                        "url-1080-SDR": 0,
-                                        "url-1080-HDR": 0,
-                                        "url-4K-SDR": 0,
-                                        "url-4K-HDR": 0}
-        quality_total_video_count = {"url-1080-H264": 0,
-                                        "url-1080-SDR": 0,
-                                        "url-1080-HDR": 0,
-                                        "url-4K-SDR": 0,
-                                        "url-4K-HDR": 0}
 
-        # Define the locations as a set so we get deduping
-        locations = set()
+# Yield (location, quality, url, file name) for every video of every scene in the feed
+def iter_feed_videos(top_level):
+    # Top-level JSON has assets array, initialAssetCount, version. Inspect each block in assets
+    for block in top_level["assets"]:
+        # Each block contains a location/scene whose name is stored in accessibilityLabel. These may recur
+        for video_version in quality_keys:
+            asset_url = block.get(video_version)
+            if not asset_url:
+                continue
+            # If the URL contains HTTPS, we need revert to HTTP to avoid bad SSL cert
+            # NOTE: Old Apple URLs were HTTP, new URLs are HTTPS with a bad cert
+            asset_url = asset_url.replace("https://", "http://")
+            yield block["accessibilityLabel"], video_version, asset_url, asset_url.split("/")[-1]
+
+
+# Hash a video straight from the HTTP response, nothing is written to disk. Returns (checksum, size in bytes, ETag)
+def md5_of_url(url):
+    for attempt in range(1, download_attempts + 1):
+        try:
+            digest = hashlib.md5()
+            size = 0
+            with request.urlopen(url, timeout=60) as response:
+                etag = response.headers.get("ETag")
+                for buffer in iter(lambda: response.read(hash_block_size), b""):
+                    digest.update(buffer)
+                    size += len(buffer)
+            return digest.hexdigest(), size, etag
+        except OSError as e:
+            if attempt == download_attempts:
+                raise
+            print("Retrying {} after error: {}".format(url, e))
+
+
+# Kept-alive connections of the current thread, {(scheme, host): connection}, reused by its HEAD requests
+_connections = threading.local()
+
+
+def _connection_for(scheme, host):
+    pool = _connections.__dict__.setdefault("pool", {})
+    if (scheme, host) not in pool:
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        pool[(scheme, host)] = connection_class(host, timeout=60)
+    return pool[(scheme, host)]
+
+
+# Send a HEAD request for url over a pooled connection, following redirects. Returns the final response,
+# already read so its connection can take the next request
+def head_url(url):
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        # A kept-alive connection may have been closed by the server since its last request, retry on a new one
+        for attempt in range(2):
+            connection = _connection_for(parts.scheme, parts.netloc)
+            try:
+                connection.request("HEAD", path)
+                response = connection.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                del _connections.pool[(parts.scheme, parts.netloc)]
+                if attempt:
+                    raise
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            url = urljoin(url, response.getheader("Location"))
+            continue
+        return response
+    raise OSError("Too many redirects for {}".format(url))
+
 
+# Size in bytes and ETag of a video, without downloading it
+def validators_of_url(url):
+    response = head_url(url)
+    if response.status != 200:
+        raise OSError("HTTP {}".format(response.status))
+    return int(response.getheader("Content-Length", -1)), response.getheader("ETag")
+
+
+# The file names of the videos whose size or ETag differ from the ones they had when they were hashed
+def find_changed_videos(videos, validators, workers):
+    def changed(file_name):
+        _, asset_url = videos[file_name]
+        try:
+            size, etag = validators_of_url(asset_url)
+        except (http.client.HTTPException, OSError) as e:
+            print("Could not check {}, hashing it again: {}".format(asset_url, e))
+            return True
+        stored = validators[file_name]
+        return size != stored["size"] or (etag is not None and stored["etag"] is not None and etag != stored["etag"])
+
+    file_names = [file_name for file_name in videos if file_name in validators]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {file_name for file_name, is_changed in zip(file_names, executor.map(changed, file_names)) if is_changed}
+
+
+def load_json_file(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+# Write a JSON file under a temporary name first so an interrupted run never leaves a truncated file behind
+def write_json_atomically(path, data):
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps(data))
+    os.replace(path + ".tmp", path)
+
+
+# Hash every video of the feed and write checksums.json. With incremental, only the videos that have no checksum
+# yet or whose size or ETag changed since they were hashed are downloaded, and merged into the existing checksums
+def generate_entries_and_checksums(workers=checksum_workers, feed_path=apple_local_feed,
+                                   checksums_path=local_checksums, state_path=checksum_state_file,
+                                   validators_path=local_validators, incremental=False):
+    with open(feed_path) as feed_file:
         top_level = json.load(feed_file)
-        # Top-level JSON has assets array, initialAssetCount, version. Inspect each block in assets
-        for block in top_level["assets"]:
-            # Each block contains a location/scene whose name is stored in accessibilityLabel. These may recur
-            current_scene = block["accessibilityLabel"]
-            print("Processing videos for scene:", current_scene)
-            locations.add(current_scene)
-
-            # https://realpython.com/iterate-through-dictionary-python/#iterating-through-keys
-            for video_version in quality_total_size_megabytes.keys():
-                try:
-                    # Try to look up the URL, but catch the KeyError and continue if it wasn't available
-                    asset_url = block[video_version]
-
-                    # If the URL contains HTTPS, we need revert to HTTP to avoid bad SSL cert
-                    # NOTE: Old Apple URLs were HTTP, new URLs are HTTPS with a bad cert
-                    if "https" in asset_url:
-                        asset_url = asset_url.replace("https://", "http://")
-
-                    print("Downloading video:", asset_url)
-
-                    # Construct the name and path of the local file
-                    local_file_name = asset_url.split("/")[-1]
-                    local_file_path = os.path.join(tmp_folder, local_file_name)
-
-                    # Download the file to local storage
-                    request.urlretrieve(asset_url, local_file_path)
-
-                    # Get the size of the file in bytes and add it to an overall size counter
-                    quality_total_size_megabytes[video_version] += os.path.getsize(local_file_path) / 1000 / 1000
-                    # We found a valid file for the given version, update the count
-                    quality_total_video_count[video_version] += 1
-
-                    # Try to open the file
-                    with open(local_file_path, "rb") as f:
-                        # Compute the checksum
-                        checksum = hashlib.md5(f.read()).hexdigest()
-                        # Add the checksum to the dict of checksums we're keeping
-                        checksums[local_file_name] = checksum
-
-                    # Delete the local copy of the file
-                    os.remove(local_file_path)
-                    print("File processed. Checksum:", checksum)
-                except KeyError:
-                    print("Can't find URL for asset type:", video_version)
-
-        # Now that we've processed all videos, delete the temp directory
-        os.rmdir(tmp_folder)
-
-        # Then write the checksums to file
-        with open(os.path.join("resources", "checksums.json"), "w") as f:
-            print("Writing checksums to disk")
-            f.write(json.dumps(checksums))
-
-        print("Total Megabytes of all video files, per quality:")
-        print(quality_total_size_megabytes)
-        print("Total count of all video files, per quality:")
-        print(quality_total_video_count)
-        print("Locations seen:")
-        print(locations)
-        print("Stopping checksum generator...")
+
+    print("Starting checksum generator with {} parallel downloads...".format(workers))
+    # Results of a previous interrupted run: {file name: {"checksum", "size", "etag", "quality"}}
+    state = load_json_file(state_path)
+    if state:
+        print("Resuming, {} videos were already processed".format(len(state)))
+    state_lock = threading.Lock()
+
+    # Define the locations as a set so we get deduping
+    locations = set()
+    videos = {}
+    for location, video_version, asset_url, file_name in iter_feed_videos(top_level):
+        locations.add(location)
+        videos[file_name] = (video_version, asset_url)
+
+    checksums = load_json_file(checksums_path) if incremental else {}
+    validators = load_json_file(validators_path)
+    if incremental:
+        changed = find_changed_videos({file_name: video for file_name, video in videos.items()
+                                       if file_name in checksums and file_name not in state}, validators, workers)
+        videos = {file_name: video for file_name, video in videos.items()
+                  if file_name not in checksums or file_name in changed}
+        print("{} new and {} changed videos to hash".format(len(videos) - len(changed), len(changed)))
+    videos = {file_name: video for file_name, video in videos.items() if file_name not in state}
+
+    def process(file_name, video_version, asset_url):
+        print("Downloading video: {}".format(asset_url))
+        checksum, size, etag = md5_of_url(asset_url)
+        with state_lock:
+            state[file_name] = {"checksum": checksum, "size": size, "etag": etag, "quality": video_version}
+            # Save progress after every video so an interrupted run resumes where it stopped
+            write_json_atomically(state_path, state)
+        print("File processed. Checksum: {}".format(checksum))
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process, file_name, video_version, asset_url): asset_url
+                   for file_name, (video_version, asset_url) in videos.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to process {}: {}".format(futures[future], e))
+                failed.append(futures[future])
+
+    if failed:
+        print("{} videos failed, run again to resume with only those".format(len(failed)))
+        return
+
+    # Dictionary to store the quality levels and the size in megabytes for each
+    # Within each scene, there may be: H264/HEVC, 1080p/4K, SDR/HDR
+    quality_total_size_megabytes = {video_version: 0 for video_version in quality_keys}
+    quality_total_video_count = {video_version: 0 for video_version in quality_keys}
+    for entry in state.values():
+        quality_total_size_megabytes[entry["quality"]] += entry["size"] / 1000 / 1000
+        quality_total_video_count[entry["quality"]] += 1
+
+    # Then write the checksums to file, the validators last so a video is never marked as hashed without its checksum
+    print("Writing checksums to disk")
+    checksums.update((file_name, entry["checksum"]) for file_name, entry in state.items())
+    write_json_atomically(checksums_path, checksums)
+    validators.update((file_name, {"size": entry["size"], "etag": entry.get("etag")})
+                      for file_name, entry in state.items())
+    write_json_atomically(validators_path, validators)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    print("Total Megabytes of the video files hashed, per quality:")
+    print(quality_total_size_megabytes)
+    print("Total count of the video files hashed, per quality:")
+    print(quality_total_video_count)
+    print("Locations seen:")
+    print(locations)
+    print("Stopping checksum generator...")
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+    for row in [headers] + rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+# Ask the server for the size of every video of the feed, without downloading any, and print how much each quality
+# and location takes and which videos are unavailable. The sizes are saved for the addon
+def report_sizes_and_availability(workers=report_workers, feed_path=apple_local_feed, sizes_path=local_sizes):
+    with open(feed_path) as feed_file:
+        top_level = json.load(feed_file)
+
+    # {file name: (location, quality, url)}, a video listed twice is only asked for once
+    videos = {file_name: (location, video_version, asset_url)
+              for location, video_version, asset_url, file_name in iter_feed_videos(top_level)}
+    print("Asking for the size of {} videos with {} parallel requests...".format(len(videos), workers))
+
+    def size_of(file_name):
+        asset_url = videos[file_name][2]
+        try:
+            response = head_url(asset_url)
+        except (http.client.HTTPException, OSError) as e:
+            print("Unavailable: {} ({})".format(asset_url, e))
+            return None
+        if response.status != 200 or response.getheader("Content-Length") is None:
+            print("Unavailable: {} (HTTP {})".format(asset_url, response.status))
+            return None
+        return int(response.getheader("Content-Length"))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = dict(zip(videos, executor.map(size_of, videos)))
+
+    # {quality: [videos, unavailable, bytes]} and {location: {quality: bytes}, with its count of unavailable videos}
+    by_quality = {video_version: [0, 0, 0] for video_version in quality_keys}
+    by_location = {}
+    unavailable_by_location = {}
+    for file_name, (location, video_version, _) in videos.items():
+        quality_totals = by_quality[video_version]
+        location_totals = by_location.setdefault(location, {video_version: 0 for video_version in quality_keys})
+        quality_totals[0] += 1
+        if sizes[file_name] is None:
+            quality_totals[1] += 1
+            unavailable_by_location[location] = unavailable_by_location.get(location, 0) + 1
+        else:
+            quality_totals[2] += sizes[file_name]
+            location_totals[video_version] += sizes[file_name]
+
+    print("\nPer quality:")
+    print_table(["quality", "videos", "unavailable", "MB"],
+                [[video_version, count, unavailable, round(size / 1000 / 1000)]
+                 for video_version, (count, unavailable, size) in by_quality.items()])
+    print("\nPer location, MB:")
+    print_table(["location", "unavailable"] + quality_keys,
+                [[location, unavailable_by_location.get(location, 0)] +
+                 [round(location_totals[video_version] / 1000 / 1000) for video_version in quality_keys]
+                 for location, location_totals in sorted(by_location.items())])
+
+    write_json_atomically(sizes_path, {file_name: size for file_name, size in sizes.items() if size is not None})
+    print("\nSizes written to {}".format(sizes_path))
 
 
 def get_locations():
@@ -141,13 +332,20 @@ def get_locations():
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         if sys.argv[1] == "1":
-            generate_entries_and_checksums()
+            generate_entries_and_checksums(int(sys.argv[2]) if len(sys.argv) > 2 else checksum_workers)
         elif sys.argv[1] == "2":
             get_latest_entries_from_apple()
         elif sys.argv[1] == "3":
             get_locations()
+        elif sys.argv[1] == "4":
+            generate_entries_and_checksums(int(sys.argv[2]) if len(sys.argv) > 2 else checksum_workers,
+                                           incremental=True)
+        elif sys.argv[1] == "5":
+            report_sizes_and_availability(int(sys.argv[2]) if len(sys.argv) > 2 else report_workers)
     else:
         print("Please specify option:\n "
-              "1) Update checksums based on existing entries.json \n "
+              "1) Update checksums based on existing entries.json (optionally: 1 <parallel downloads>) \n "
               "2) Update entries.json from Apple \n "
-              "3) Print all locations in entries.json")
+              "3) Print all locations in entries.json \n "
+              "4) Only hash the new or changed videos of entries.json (optionally: 4 <parallel downloads>) \n "
+              "5) Report the size and availability of the videos in entries.json (optionally: 5 <parallel requests>)")
@@ -10,4 +10,4 @@ import sys
 
 from resources.lib import atv
 
-atv.run(len(sys.argv) > 1)
+atv.run(sys.argv[1] if len(sys.argv) > 1 else False)
@@ -8,18 +8,33 @@
 
 import json
 import threading
+import time
 import random # Added for random seek
 import os # Added for path comparison
 
 import xbmc
 import xbmcgui
 
-from .commonatv import translate, addon, addon_path
+from . import telemetry
+from .catalog import load_catalog
+from .commonatv import translate, addon, addon_path, notification, video_file_name
 from .offline import offline
-from .playlist import AtvPlaylist
+from .history import PlayHistory
+from .player import AtvPlayer
+from .playlist import AtvPlaylist, load_playlist_snapshot
+from .prefetch import PrefetchCache
+from .quality import AdaptiveQuality
+from .settings import SettingsMonitor, get_settings
 from .trans import ScreensaverTrans
+from .verification import VerificationIndex
 
-monitor = xbmc.Monitor()
+# Also drops the settings snapshot if the user changes a setting while we run
+monitor = SettingsMonitor()
+
+# Clips queued in Kodi's playlist after the one playing, so Kodi can open the next stream ahead of time
+queue_window = 2
+# Clips played before the queue is built again, so it doesn't grow for as long as the screensaver runs
+played_window = 50
 
 
 class Screensaver(xbmcgui.WindowXML):
@@ -30,8 +45,31 @@ class Screensaver(xbmcgui.WindowXML):
                             'result']['value'] * 60
         self.isDPMSactive = bool(self.DPMStime > 0)
         self.active = True
+        self.activated_at = time.time()
         self.atv4player = None
-        self.video_playlist = AtvPlaylist().compute_playlist_array()
+        self.dpms_timer = None
+        # Kodi's video playlist, the clips queued in it, what Kodi opens for each (a cached copy or another
+        # rendition) and where each starts, and the position of the one playing
+        self.kodi_playlist = None
+        # What the user had in Kodi's video playlist, put back on exit
+        self.user_queue = None
+        self.queued = []
+        self.sources = []
+        self.start_offsets = []
+        self.position = -1
+        self.current_video = None
+        # When the clip on screen started, how long it is and where it started, to measure transition gaps
+        self.clip_started_at = None
+        self.clip_length = 0
+        # Fetches the clips after the queued ones while the current one plays, when streaming from Apple
+        self.prefetch_cache = None
+        # Picks the rendition of each streamed clip from what recent clips measured
+        self.quality = None
+        self.play_requested_at = None
+        # Catalog used to start Apple clips at one of their points of interest
+        self.catalog = None
+        # Use the playlist prepared by the background service, only build one here if it isn't available
+        self.video_playlist = load_playlist_snapshot() or AtvPlaylist().compute_playlist_array()
         xbmc.log(msg=f"kodi dpms time: {self.DPMStime}", level=xbmc.LOGDEBUG)
         xbmc.log(msg=f"kodi dpms active: {self.isDPMSactive}", level=xbmc.LOGDEBUG)
 
@@ -41,59 +79,72 @@ class Screensaver(xbmcgui.WindowXML):
 
         if self.video_playlist:
             self.setProperty("screensaver-atv4-loading", "false")
-            self.atv4player = xbmc.Player()
-
-            # Start player thread
-            threading.Thread(target=self.start_playback).start()
+            # Clips are chained from the player callbacks, nothing runs while a clip plays
+            self.atv4player = AtvPlayer(on_started=self.on_clip_started, on_finished=self.on_clip_finished)
+            settings = get_settings()
+            if settings.adaptive_quality and not settings.force_offline:
+                self.quality = AdaptiveQuality(settings.block_key_list)
+            if settings.prefetch_clips and not settings.force_offline:
+                self.prefetch_cache = PrefetchCache(settings.prefetch_cache_mb * 1024 * 1024)
+                if self.quality:
+                    # Prefetching is a full speed download from Apple, the best throughput sample we get
+                    self.prefetch_cache.on_fetched = self.quality.record_throughput
+            if settings.start_at_poi:
+                self.catalog = load_catalog()
+            # Carry on the round of clips of the previous sessions, optionally favouring clips already on disk
+            self.history = PlayHistory()
+            self.video_playlist.use_history(self.history,
+                                            prefer=self.is_local if settings.prefer_local_clips else None)
+            self.start_playback()
 
             # DPMS logic
             self.max_allowed_time = None
 
-            if self.isDPMSactive and addon.getSettingInt("check-dpms") == 1:
+            if self.isDPMSactive and settings.check_dpms == 1:
                 self.max_allowed_time = self.DPMStime
 
-            elif addon.getSettingInt("check-dpms") == 2:
-                self.max_allowed_time = addon.getSettingInt("manual-dpms") * 60
+            elif settings.check_dpms == 2:
+                self.max_allowed_time = settings.manual_dpms * 60
 
-            xbmc.log(msg=f"check dpms: {addon.getSetting('check-dpms')}",
+            xbmc.log(msg=f"check dpms: {settings.check_dpms}",
                      level=xbmc.LOGDEBUG)
             xbmc.log(msg=f"before supervision: {self.max_allowed_time}",
                      level=xbmc.LOGDEBUG)
 
             if self.max_allowed_time:
-                delta = 0
-                while self.active:
-                    if delta >= self.max_allowed_time:
-                        self.activateDPMS()
-                        break
-                    monitor.waitForAbort(1)
-                    delta += 1
+                # A single timer fires when the display is due to sleep instead of counting every second
+                self.dpms_timer = threading.Timer(self.max_allowed_time, self.activateDPMS)
+                self.dpms_timer.daemon = True
+                self.dpms_timer.start()
         else:
             self.novideos()
 
     def activateDPMS(self):
+        if not self.active or monitor.abortRequested():
+            return
         xbmc.log(msg="[Aerial Screensaver] Manually activating DPMS!", level=xbmc.LOGDEBUG)
         self.active = False
 
+        settings = get_settings()
         # Take action on the video
         enable_window_placeholder = False
-        if addon.getSettingInt("dpms-action") == 0:
+        if settings.dpms_action == 0:
             self.atv4player.pause()
         else:
             self.clearAll()
             enable_window_placeholder = True
 
-        if addon.getSettingBool("toggle-displayoff") or addon.getSettingBool("toggle-cecoff"):
+        if settings.toggle_displayoff or settings.toggle_cecoff:
             monitor.waitForAbort(1)
 
-        if addon.getSettingBool("toggle-displayoff"):
+        if settings.toggle_displayoff:
             try:
                 xbmc.executebuiltin('ToggleDPMS')
             except Exception as e:
                 xbmc.log(msg=f"[Aerial Screensaver] Failed to toggle DPMS: {e}",
                          level=xbmc.LOGDEBUG)
 
-        if addon.getSetting("toggle-cecoff") == "true":
+        if settings.toggle_cecoff:
             try:
                 xbmc.executebuiltin('CECStandby')
             except Exception as e:
@@ -123,51 +174,167 @@ class Screensaver(xbmcgui.WindowXML):
 
     def clearAll(self, close=True):
         self.active = False
+        if self.dpms_timer:
+            self.dpms_timer.cancel()
+        if self.prefetch_cache:
+            self.prefetch_cache.stop()
+        telemetry.flush("screensaver")
         if self.atv4player:
             self.atv4player.stop()
+        if self.kodi_playlist:
+            self.kodi_playlist.clear()
+            for list_item in self.user_queue or ():
+                self.kodi_playlist.add(list_item.getPath(), list_item)
         self.close()
 
     def onAction(self, action):
         addon.setSettingBool("is_locked", False)
         self.clearAll()
 
-    def start_playback(self):
-        self.playindex = 0
-        current_video_path = self.video_playlist[self.playindex]
-        self.atv4player.play(current_video_path, windowed=True)
-        self.apply_random_seek_if_needed(current_video_path)
-
-        while self.active and not monitor.abortRequested():
-            monitor.waitForAbort(0.1) # Shorter wait for more responsive check
-            # If we finish playing the video
-            if not self.atv4player.isPlaying() and self.active:
-                # Increment the iterator used to access the array or reset to 0
-                if self.playindex < len(self.video_playlist) - 1:
-                    self.playindex += 1
-                else:
-                    self.playindex = 0
-                # Using the updated iterator, start playing the next video
-                current_video_path = self.video_playlist[self.playindex]
-                self.atv4player.play(current_video_path, windowed=True)
-                self.apply_random_seek_if_needed(current_video_path)
-
+    # Queue the next clips in Kodi's playlist and play it. Kodi moves from one clip to the next by itself,
+    # without the stop, re-open and new HTTP connection of a play() per clip. pending are clips that were
+    # pulled from the playlist but not played yet, they go first
+    def start_playback(self, pending=()):
+        self.queued = []
+        self.sources = []
+        self.start_offsets = []
+        self.position = -1
+        self.kodi_playlist = xbmc.PlayList(xbmc.PLAYLIST_VIDEO)
+        if self.user_queue is None:
+            # Kodi has a single video playlist, keep the clips the user queued in it
+            self.user_queue = [self.kodi_playlist[index] for index in range(self.kodi_playlist.size())]
+        self.kodi_playlist.clear()
+        for video in pending:
+            self.add_to_queue(video)
+        self.enqueue(queue_window + 1 - len(self.queued))
+        self.play_requested_at = time.time()
+        self.atv4player.play(self.kodi_playlist, windowed=True)
+
+    # Pull the next count clips from the playlist, only as they are needed
+    def enqueue(self, count):
+        for _ in range(count):
+            self.add_to_queue(self.video_playlist.next_video())
+
+    def add_to_queue(self, video):
+        source = self.source_for(video)
+        start_offset = self.start_offset_for(video)
+        list_item = xbmcgui.ListItem(path=source)
+        if start_offset:
+            # Kodi opens the clip at that point, there is no seek and no jump once it shows
+            list_item.setProperty("StartOffset", str(start_offset))
+        self.kodi_playlist.add(source, list_item)
+        self.queued.append(video)
+        self.sources.append(source)
+        self.start_offsets.append(start_offset)
+
+    # A random point of interest of an Apple clip other than its start, in seconds. 0 for anything else
+    def start_offset_for(self, video):
+        if not self.catalog:
+            return 0
+        asset = self.catalog.asset_for_file(video_file_name(video))
+        if asset is None:
+            return 0
+        offsets = [int(offset) for offset in asset.points_of_interest if offset.isdigit() and int(offset) > 0]
+        return random.choice(offsets) if offsets else 0
+
+    # What Kodi should open for video: the prefetched copy when the clip made it to the cache,
+    # otherwise the rendition the adaptive quality picks
+    def source_for(self, video):
+        if self.prefetch_cache and self.prefetch_cache.resolve(video) != video:
+            return self.prefetch_cache.resolve(video)
+        if self.quality:
+            video = self.quality.rendition_for(video)
+        if self.prefetch_cache:
+            video = self.prefetch_cache.resolve(video)
+        return video
+
+    # Whether a clip plays without fetching it from Apple
+    def is_local(self, video):
+        if not video.startswith("http"):
+            return True
+        return bool(self.prefetch_cache) and self.prefetch_cache.resolve(video) != video
+
+    def on_clip_started(self):
+        if not self.active:
+            return
+        now = time.time()
+        position = self.kodi_playlist.getposition()
+        if 0 <= position < len(self.queued):
+            if position == self.position:
+                # Kodi's repeat mode brought the same clip back, move on as we would without it
+                self.atv4player.playnext()
+                return
+            self.position = position
+            self.current_video = self.queued[position]
+            telemetry.count("clips_played")
+            self.history.mark_played(self.current_video)
+            # Keep the window of upcoming clips full
+            self.enqueue(position + queue_window + 1 - len(self.queued))
+            if self.prefetch_cache:
+                self.prefetch_cache.touch(self.current_video)
+                # The queued clips are already opened by Kodi, fetch the ones that come after them
+                upcoming = self.video_playlist.peek(get_settings().prefetch_clips)
+                if self.quality:
+                    upcoming = [self.quality.rendition_for(video) for video in upcoming]
+                self.prefetch_cache.prefetch(upcoming,
+                                             in_use=self.sources[position:])
+
+        if self.clip_started_at is not None:
+            gap = now - self.clip_started_at - self.clip_length
+            xbmc.log(f"[Aerial Screensaver] Transition gap: {gap:.3f}s", level=xbmc.LOGDEBUG)
+            telemetry.measure("clip_gap", gap)
+        else:
+            if self.activated_at:
+                telemetry.measure("time_to_first_frame", now - self.activated_at)
+                self.activated_at = None
+            # First clip of the queue, it had to wait for play()
+            gap = now - self.play_requested_at
+        if self.quality and 0 <= position < len(self.queued):
+            self.quality.record_startup(self.sources[position], gap)
+        self.clip_started_at = now
+        try:
+            duration = self.atv4player.getTotalTime()
+        except Exception:
+            duration = 0
+        seek_to = self.apply_random_seek_if_needed(self.current_video)
+        if not seek_to and 0 <= position < len(self.start_offsets):
+            seek_to = self.start_offsets[position]
+        self.clip_length = duration - seek_to
+
+    # Called by the player when a clip ended, failed or was stopped. Kodi reports the end of every clip of
+    # the queue and moves to the next one by itself, the queue is only built again when a clip failed, playback
+    # was stopped, the queue really ran out or played_window clips were played from it
+    def on_clip_finished(self, error, stopped):
+        if not self.active or monitor.abortRequested():
+            return
+        position = self.kodi_playlist.getposition()
+        if not 0 <= position < len(self.queued):
+            position = max(self.position, 0)
+        if not error and not stopped and position < min(len(self.queued) - 1, played_window):
+            return
+        if error:
+            xbmc.log(f"[Aerial Screensaver] Failed to play {self.queued[position]}", level=xbmc.LOGWARNING)
+            telemetry.count("clip_failed")
+            if self.quality:
+                self.quality.record_failure(self.sources[position])
+            # Don't spin through the playlist if every clip fails right away (e.g. network down)
+            if monitor.waitForAbort(1) or not self.active:
+                return
+        self.clip_started_at = None
+        # Queue again from the clip after the one that was playing
+        self.start_playback(self.queued[position + 1:])
+
+    # Seek to a random point of long local videos if enabled. Returns the position seeked to, in seconds
     def apply_random_seek_if_needed(self, video_path):
-        if addon.getSettingBool("random-seek-local"):
-            extra_folder = addon.getSetting("extra-local-folder")
+        settings = get_settings()
+        if settings.random_seek_local:
+            extra_folder = settings.extra_local_folder
             # Check if the video_path starts with the extra_folder path
             # Normalize paths to account for potential differences (e.g., trailing slashes)
             if extra_folder and video_path.startswith(os.path.normpath(extra_folder)):
                 xbmc.log(f"[Aerial Screensaver] Random seek enabled for local file: {video_path}", level=xbmc.LOGDEBUG)
-                
-                # Wait for player to be ready, with a timeout
-                for _ in range(50): # Try for up to 5 seconds (50 * 100ms)
-                    if self.atv4player.isPlayingVideo() and self.atv4player.getTotalTime() > 0:
-                        break
-                    xbmc.sleep(100)
-                else:
-                    xbmc.log("[Aerial Screensaver] Player not ready or video duration is 0 for random seek.", level=xbmc.LOGWARNING)
-                    return
 
+                # Called from onAVStarted, the duration is known by then and there is nothing to wait for
                 try:
                     duration = self.atv4player.getTotalTime()
                     xbmc.log(f"[Aerial Screensaver] Video duration: {duration}s", level=xbmc.LOGDEBUG)
@@ -182,10 +349,12 @@ class Screensaver(xbmcgui.WindowXML):
                         
                         self.atv4player.seekTime(seek_to)
                         xbmc.log(f"[Aerial Screensaver] Seeking to {seek_to}s", level=xbmc.LOGDEBUG)
+                        return seek_to
                     else:
                         xbmc.log("[Aerial Screensaver] Video too short for random seek.", level=xbmc.LOGDEBUG)
                 except Exception as e:
                     xbmc.log(f"[Aerial Screensaver] Error during random seek: {e}", level=xbmc.LOGERROR)
+        return 0
 
 
 def run(params=False):
@@ -201,6 +370,13 @@ def run(params=False):
         xbmc.sleep(100)
         del screensaver
 
+    elif params == "clear-verification":
+        # Forget every verified file so the next offline sync hashes them again
+        verification_index = VerificationIndex()
+        verification_index.invalidate()
+        verification_index.save()
+        notification(translate(32000), translate(32139))
+
     else:
         # Params existed or was true when calling run(), so download files locally
         offline()
@@ -0,0 +1,81 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import time
+
+import xbmc
+import xbmcvfs
+
+from . import telemetry
+from .commonatv import addon
+from .feed import get_latest_entries_from_apple
+from .playlist import AtvPlaylist, playlist_snapshot_path, save_playlist_snapshot, invalidate_playlist_snapshot
+from .settings import get_settings, invalidate_settings
+
+# How often the service wakes up to check if there is work to do
+poll_interval = 30
+# The playlist snapshot is rebuilt after this many seconds...
+snapshot_max_age = 3600
+# ...but only once Kodi has been left alone for this long, so we never compete with the user
+idle_seconds = 60
+
+
+class BackgroundService(xbmc.Monitor):
+    # Keeps the feed and the playlist snapshot fresh so the screensaver starts without network or disk scans
+
+    def __init__(self):
+        super().__init__()
+        self.dirty = True
+        self.last_refresh = 0
+        self.fingerprint = get_settings().playlist_key()
+
+    def onSettingsChanged(self):
+        invalidate_settings()
+        # Locations, quality or folders changed the playlist: drop it now and rebuild it soon.
+        # Other settings, like is_locked which flips on every activation, are ignored
+        fingerprint = get_settings().playlist_key()
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            invalidate_playlist_snapshot()
+            self.dirty = True
+
+    def should_refresh(self):
+        # Never do the work while the screensaver or the user needs the box
+        if xbmc.getCondVisibility("System.ScreenSaverActive") or xbmc.getCondVisibility("Player.HasMedia"):
+            return False
+        if addon.getSettingBool("is_locked"):
+            return False
+        # The snapshot is also dropped from the screensaver process, e.g. after a download, which can't set dirty
+        if self.dirty or not xbmcvfs.exists(playlist_snapshot_path):
+            return True
+        return time.time() - self.last_refresh >= snapshot_max_age and xbmc.getGlobalIdleTime() >= idle_seconds
+
+    def refresh(self):
+        xbmc.log("[Aerial Screensaver] Refreshing the feed and the playlist snapshot", level=xbmc.LOGDEBUG)
+        self.dirty = False
+        self.last_refresh = time.time()
+        settings = get_settings()
+        if not settings.force_offline and settings.get_videos_from_apple:
+            try:
+                get_latest_entries_from_apple()
+            except Exception as e:
+                xbmc.log("Caught an exception while retrieving Apple's resources.tar to extract entries.json: {}".format(e),
+                         level=xbmc.LOGWARNING)
+        try:
+            save_playlist_snapshot(AtvPlaylist(refresh_feed=False, wait_for_scan=True).compute_playlist_array())
+        except Exception as e:
+            xbmc.log("[Aerial Screensaver] Could not compute the playlist snapshot: {}".format(e),
+                     level=xbmc.LOGERROR)
+        telemetry.flush("service")
+
+    def run(self):
+        while not self.abortRequested():
+            if self.should_refresh():
+                self.refresh()
+            if self.waitForAbort(poll_interval):
+                break
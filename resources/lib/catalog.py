@@ -0,0 +1,154 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import pickle
+
+import xbmc
+import xbmcvfs
+
+from . import telemetry
+from .commonatv import addon_profile, find_ranked_key_in_dict, video_file_name, atomic_write
+from .feed import local_entries_json_path
+
+# Compiled form of entries.json, rebuilt only when entries.json changes
+compiled_catalog_path = os.path.join(addon_profile, "catalog.pickle")
+# Bump whenever Asset or Catalog change shape so stale pickles are ignored
+catalog_format_version = 6
+
+# Every URL key Apple uses, from the best to the most compatible rendition
+quality_keys = ["url-4K-HDR", "url-4K-SDR", "url-1080-HDR", "url-1080-SDR", "url-1080-H264"]
+
+# When a scene suits: shot at night, in daylight, or either (views from space show both sides of the planet)
+times_of_day = ["day", "night", "any"]
+# Category whose scenes suit any time of day, by its name in entries.json
+any_time_category = "space"
+# entries.json has no time of day (the points of interest only name strings that aren't in the feed), it is
+# guessed from words in the shot id or label. Night ones win over the space category, so a view of the night side
+# of the planet like "Africa Night" is night only and one of the day side like "Caribbean Day" is day only
+night_words = ("NIGHT", "AURORA")
+day_words = ("DAY",)
+
+
+class Asset:
+    __slots__ = ("location", "shot_id", "urls", "categories", "points_of_interest", "time_of_day")
+
+    def __init__(self, block):
+        # Each block contains a location/scene whose name is stored in accessibilityLabel. These may recur
+        self.location = block["accessibilityLabel"]
+        self.shot_id = block.get("shotID")
+        self.categories = tuple(block.get("categories") or ())
+        self.points_of_interest = block.get("pointsOfInterest") or {}
+        # Set by the catalog, which knows the category names
+        self.time_of_day = "day"
+        self.urls = {}
+        for key in quality_keys:
+            url = block.get(key)
+            if url:
+                # If the URL contains HTTPS, we need revert to HTTP to avoid bad SSL cert
+                # NOTE: Old Apple URLs were HTTP, new URLs are HTTPS with a bad cert
+                self.urls[key] = url.replace("https://", "http://")
+
+    # Given the ranked list of URL keys, return the first URL this asset has
+    def url_for(self, block_key_list):
+        return find_ranked_key_in_dict(self.urls, block_key_list)
+
+
+class Catalog:
+    __slots__ = ("version", "source_size", "source_mtime", "assets", "by_location", "by_file_name", "by_time_of_day")
+
+    def __init__(self, top_level_json, source_size=None, source_mtime=None):
+        self.version = catalog_format_version
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        # Top-level JSON has assets array, initialAssetCount, categories, version. Only assets matter to us
+        self.assets = [Asset(block) for block in top_level_json.get("assets", [])]
+        self.by_location = {}
+        self.by_file_name = {}
+        self.by_time_of_day = {time_of_day: [] for time_of_day in times_of_day}
+        # Category ids to names, "AerialCategoryCities" becomes "cities"
+        category_names = {category["id"]: category.get("localizedNameKey", "").replace("AerialCategory", "").lower()
+                          for category in top_level_json.get("categories", [])}
+        for asset in self.assets:
+            names = [category_names.get(category_id, category_id) for category_id in asset.categories]
+            # e.g. AFRICA_NIGHT, "New York Night", NORTH_AMERICA_AURORA or CARIBBEAN_DAY
+            words = set((asset.shot_id or "").upper().split("_")) | set(asset.location.upper().split())
+            if words.intersection(night_words):
+                asset.time_of_day = "night"
+            elif words.intersection(day_words):
+                asset.time_of_day = "day"
+            elif any_time_category in names:
+                asset.time_of_day = "any"
+            self.by_time_of_day[asset.time_of_day].append(asset)
+            self.by_location.setdefault(asset.location, []).append(asset)
+            for url in asset.urls.values():
+                self.by_file_name[url.split("/")[-1]] = asset
+
+    def locations(self):
+        return sorted(self.by_location)
+
+    # The assets of locations, only those that suit one of times_of_day if given
+    def assets_for_locations(self, locations, times_of_day=None):
+        if times_of_day is None:
+            for location in locations:
+                yield from self.by_location.get(location, ())
+            return
+        locations = set(locations)
+        for time_of_day in times_of_day:
+            for asset in self.by_time_of_day[time_of_day]:
+                if asset.location in locations:
+                    yield asset
+
+    # When the scene of a video suits, "any" for videos that aren't in the catalog (extra local files)
+    def time_of_day_for(self, video):
+        asset = self.asset_for_file(video_file_name(video))
+        return asset.time_of_day if asset else "any"
+
+    # The asset one of whose renditions has this file name, in any folder
+    def asset_for_file(self, file_name):
+        return self.by_file_name.get(file_name)
+
+
+# Compiled catalog of the current process, shared by the playlist and the offline downloader
+_loaded_catalog = None
+
+
+# Return the catalog for entries.json, from the compiled artifact when entries.json didn't change since
+# it was compiled. Returns None if there is no entries.json at all
+def load_catalog():
+    global _loaded_catalog
+    if not xbmcvfs.exists(local_entries_json_path):
+        xbmc.log(msg="Local entries.json not found at {}".format(local_entries_json_path), level=xbmc.LOGWARNING)
+        return None
+    stat = os.stat(local_entries_json_path)
+
+    if _loaded_catalog is not None and \
+            (_loaded_catalog.source_size, _loaded_catalog.source_mtime) == (stat.st_size, stat.st_mtime):
+        return _loaded_catalog
+
+    if xbmcvfs.exists(compiled_catalog_path):
+        try:
+            with telemetry.timer("catalog_load"), open(compiled_catalog_path, "rb") as f:
+                catalog = pickle.load(f)
+            if catalog.version == catalog_format_version and \
+                    (catalog.source_size, catalog.source_mtime) == (stat.st_size, stat.st_mtime):
+                _loaded_catalog = catalog
+                return catalog
+        except Exception as e:
+            xbmc.log("Could not load the compiled catalog, rebuilding it: {}".format(e), level=xbmc.LOGDEBUG)
+
+    xbmc.log("Compiling the catalog from {}".format(local_entries_json_path), level=xbmc.LOGDEBUG)
+    with telemetry.timer("catalog_parse"), open(local_entries_json_path, "r") as f:
+        catalog = Catalog(json.loads(f.read()), stat.st_size, stat.st_mtime)
+    try:
+        atomic_write(compiled_catalog_path, pickle.dumps(catalog, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        xbmc.log("Could not save the compiled catalog: {}".format(e), level=xbmc.LOGWARNING)
+    _loaded_catalog = catalog
+    return catalog
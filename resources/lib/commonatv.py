@@ -6,11 +6,18 @@
    See LICENSE for more information.
 """
 
+import json
+import os
+import threading
+
+import xbmc
 import xbmcaddon
 import xbmcgui
+import xbmcvfs
 
 addon = xbmcaddon.Addon()
 addon_path = addon.getAddonInfo("path")
+addon_profile = xbmcvfs.translatePath(addon.getAddonInfo("profile"))
 addon_icon = addon.getAddonInfo("icon")
 dialog = xbmcgui.Dialog()
 
@@ -24,6 +31,44 @@ def notification(header, message, time=2000, icon=addon_icon,
     xbmcgui.Dialog().notification(header, message, icon, time, sound)
 
 
+# A temporary file next to path, to write before swapping it in. Unique to the process and thread: the service
+# and the screensaver write some of the same files
+def temporary_path_for(path):
+    return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
+# Write data (str, or bytes) to path so that readers see the old file or the new one, never a truncated one
+def atomic_write(path, data):
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        xbmcvfs.mkdirs(folder)
+    temporary_path = temporary_path_for(path)
+    try:
+        with open(temporary_path, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+# The JSON content of path, or default when it is missing or can't be read
+def load_json(path, default):
+    if not xbmcvfs.exists(path):
+        return default
+    try:
+        with open(path, "r") as f:
+            return json.loads(f.read())
+    except Exception as e:
+        xbmc.log("Could not read {}, starting from scratch: {}".format(path, e), level=xbmc.LOGWARNING)
+        return default
+
+
+# The file name of a local path (with either kind of separator, Windows download folders use \\) or of a URL
+def video_file_name(video):
+    return video.replace("\\", "/").split("/")[-1]
+
+
 # Given a block and a set of keys to check, return the first one we find a nonempty value for
 def find_ranked_key_in_dict(dict, key_list):
     for key in key_list:
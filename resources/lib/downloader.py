@@ -7,15 +7,82 @@
 """
 
 import hashlib
+import heapq
 import json
+import math
 import os
+import threading
 import time
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
 
 import xbmc
 import xbmcvfs
 
+from . import telemetry
 from .commonatv import *
+from .hashing import md5_of_file
+from .settings import get_settings
+from .verification import VerificationIndex
+
+# Size of every read from an HTTP response and of every copy when joining parts
+block_sz = 64 * 1024
+# Files are only split into HTTP Range segments when each segment is at least this big
+segment_min_size = 32 * 1024 * 1024
+# Partial downloads are written next to the final file as <name>.part.<byte offset>
+part_marker = ".part."
+# Seconds a request may wait on the server before it fails, so a stalled connection can't hold a thread forever
+request_timeout = 30
+
+
+# Ask the server for the size of the file and whether it honours Range requests
+def probe_url(url):
+    with urlopen(Request(url, method="HEAD"), timeout=request_timeout) as u:
+        length = u.headers.get("Content-Length")
+        accepts_ranges = u.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(length) if length else None), accepts_ranges
+
+
+# Given the {offset: size} map of existing parts, return the (start, end) byte ranges still missing
+def compute_missing_ranges(file_size, parts):
+    missing = []
+    position = 0
+    for offset in sorted(parts):
+        if offset > position:
+            missing.append((position, offset))
+        position = max(position, offset + parts[offset])
+    if position < file_size:
+        missing.append((position, file_size))
+    return missing
+
+
+# Split the missing ranges so that up to max_segments connections can work on them at once
+def split_ranges(ranges, max_segments):
+    segments = []
+    for start, end in ranges:
+        count = max(1, min(max_segments, (end - start) // segment_min_size))
+        step = math.ceil((end - start) / count)
+        for segment_start in range(start, end, step):
+            segments.append((segment_start, min(segment_start + step, end)))
+    return segments
+
+
+class _DownloadJob:
+    # Book-keeping for a single file while its segments are being fetched
+
+    def __init__(self, url, path, name, index):
+        self.url = url
+        self.path = path
+        self.name = name
+        # Position in the download list, tasks of earlier files run first
+        self.index = index
+        self.size = None
+        self.parts = {}
+        self.pending = 0
+        self.failed = False
+        # Running md5 of the part starting at offset 0, fed while the bytes are being written
+        self.digest = None
+        self.lock = threading.Lock()
 
 
 class Downloader:
@@ -23,104 +90,312 @@ class Downloader:
     def __init__(self, ):
         self.stop = False
         self.dp = None
-        self.path = None
+        self.lock = threading.Lock()
+        self.executor = None
+        # Heap of (file index, sequence, function, arguments) of the queued tasks, each pool thread takes the first
+        self.tasks = []
+        self.task_sequence = 0
+        self.outstanding = 0
+        self.finished = threading.Event()
+        self.bytes_total = 0
+        self.bytes_done = 0
+        # Bytes fetched in this run, without the parts resumed from an earlier one
+        self.bytes_fetched = 0
+        self.files_total = 0
+        self.files_done = 0
+        # Files already complete, verified without downloading anything
+        self.files_skipped = 0
+        # URLs of the files complete in the download folder, and verified when checksums are enabled
+        self.completed = set()
+        self.current_name = ""
+        self.checksums = {}
+        self.download_folder_files = set()
+        self.verification_index = VerificationIndex()
+        self.settings = get_settings()
 
-    # Given a list of URLs, attempt to download them into the download folder
+    # Given a list of URLs, attempt to download them into the download folder. Returns the URLs of the files that
+    # are complete there
     def download_videos_from_urls(self, urllist):
+        # Nothing would ever finish and end the wait for the pool
+        if not urllist:
+            return set()
         self.dp = xbmcgui.DialogProgress()
         self.dp.create(translate(32000), translate(32019))
 
         # Get a dict of checksums (key=filename, value=checksum) if the setting is enabled
-        if addon.getSettingBool("enable-checksums"):
+        if self.settings.enable_checksums:
             with open(os.path.join(addon_path, "resources", "checksums.json")) as f:
                 checksums = f.read()
-            checksums = json.loads(checksums)
+            self.checksums = json.loads(checksums)
         else:
             # If the setting was disabled, initialize an empty dict
-            checksums = {}
-
-        for url in urllist:
-            if not self.stop:
-                # Parse out the file name and construct its expected download location
-                video_file = url.split("/")[-1]
-                local_video_path = os.path.join(addon.getSetting("download-folder"), video_file)
-
-                # If the file exists at the download location and checksums are enabled:
-                if xbmcvfs.exists(local_video_path):
-                    if addon.getSettingBool("enable-checksums"):
-                        with xbmcvfs.File(xbmcvfs.translatePath(local_video_path)) as f:
-                            # Compute the checksum in hex format from the bytes of the file
-                            file_checksum = hashlib.md5(f.readBytes()).hexdigest()
-                            # Look up its checksum if it exists and skip download if the checksum matches
-                            if video_file in checksums.keys():
-                                expected_checksum = checksums[video_file]
-                                if expected_checksum == file_checksum:
-                                    xbmc.log("Checksum of already-downloaded file {} matched, skipping download".format(
-                                        video_file), level=xbmc.LOGDEBUG)
-                                    continue
-                                xbmc.log("Calculated checksum {} did not match expected {} for file {}".format(
-                                    file_checksum, expected_checksum, video_file), level=xbmc.LOGDEBUG)
-                # If the file didn't exist, the checksum was disabled, or the checksum didn't match, download video
-                self.download(local_video_path, url, video_file)
-            else:
-                break
+            self.checksums = {}
 
-    def download(self, path, url, name):
-        xbmc.log("Downloading {}".format(url), level=xbmc.LOGDEBUG)
-        if xbmcvfs.exists(path):
-            xbmcvfs.delete(path)
+        # List the download folder once so that existing files and leftover parts are found without a stat per file
+        download_folder = self.settings.download_folder
+        self.download_folder_files = set(xbmcvfs.listdir(download_folder)[1])
 
-        self.dp.update(0, name)
-        self.path = xbmcvfs.translatePath(path)
-        xbmc.sleep(500)
+        self.files_total = len(urllist)
+        connections = self.settings.download_connections
+        self.executor = ThreadPoolExecutor(max_workers=connections)
         start_time = time.time()
+        # The submit loop counts as a task until every file is queued, so files finishing quickly (e.g. skipped as
+        # already verified) can't bring the count to 0 and end the wait below early
+        with self.lock:
+            self.outstanding += 1
+        for index, url in enumerate(urllist):
+            # Parse out the file name and construct its expected download location
+            video_file = url.split("/")[-1]
+            local_video_path = os.path.join(download_folder, video_file)
+            job = _DownloadJob(url, local_video_path, video_file, index)
+            self._submit(job, self.prepare, job, connections)
+        self._task_done()
+
+        # Keep the progress dialog on this thread while the pool does the work
+        monitor = xbmc.Monitor()
+        while not self.finished.is_set() and not monitor.abortRequested():
+            self.dialogdown(start_time)
+            if self.stop:
+                break
+            self.finished.wait(0.5)
+
+        self.executor.shutdown(wait=True)
+        self.verification_index.save()
+        self.dp.close()
+        telemetry.count("files_downloaded", self.files_done - self.files_skipped)
+        telemetry.count("files_skipped", self.files_skipped)
+        telemetry.measure("download_throughput", self.bytes_fetched / max(time.time() - start_time, 0.001))
+        telemetry.flush("downloader")
+        return self.completed
+
+    # Keep track of every queued task so we know when the whole list has been processed. Tasks run in the order
+    # of the download list rather than the order they were queued in, so the segments of a file go before the
+    # probing and hashing of the files after it and files complete in the order they were planned
+    def _submit(self, job, fn, *args):
+        with self.lock:
+            self.outstanding += 1
+            heapq.heappush(self.tasks, (job.index, self.task_sequence, fn, args))
+            self.task_sequence += 1
+        self.executor.submit(self._run_task)
+
+    def _run_task(self):
+        with self.lock:
+            _, _, fn, args = heapq.heappop(self.tasks)
+        try:
+            fn(*args)
+        except Exception as e:
+            xbmc.log("[Aerial ScreenSavers] Download task failed: {}".format(e), level=xbmc.LOGERROR)
+        finally:
+            self._task_done()
+
+    def _task_done(self):
+        with self.lock:
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.finished.set()
+
+    # Decide if a file needs downloading and queue the byte ranges that are still missing
+    def prepare(self, job, connections):
+        if self.stop:
+            return
 
-        u = urlopen(url)
-        meta = u.info()
-        meta_func = meta.getheaders if hasattr(meta, "getheaders") else meta.get_all
-        meta_length = meta_func("Content-Length")
-        file_size = None
-        block_sz = 8192
-        if meta_length:
-            file_size = int(meta_length[0])
-
-        file_size_dl = 0
-        with xbmcvfs.File(self.path, 'wb') as f:
-            numblocks = 0
-            while not self.stop:
-                buffer = u.read(block_sz)
-                if not buffer:
-                    break
-
-                f.write(buffer)
-                file_size_dl += len(buffer)
-                numblocks += 1
-                self.dialogdown(name, numblocks, block_sz, file_size, self.dp, start_time)
-
-    def dialogdown(self, name, numblocks, blocksize, filesize, dp, start_time):
+        # If the file exists at the download location and checksums are enabled:
+        if job.name in self.download_folder_files:
+            if self.settings.enable_checksums:
+                # Files left untouched since they were last verified don't need to be read at all,
+                # unless deep mode asks for every existing file to be hashed again
+                if not self.settings.deep_verify and self.verification_index.is_verified(job.path,
+                                                                                self.checksums.get(job.name)):
+                    xbmc.log("File {} is unchanged since its last verification, skipping download".format(
+                        job.name), level=xbmc.LOGDEBUG)
+                    telemetry.count("checksum_cached")
+                    self._file_done(job, skipped=True)
+                    return
+                # Compute the checksum in hex format, reading the file in bounded chunks
+                with telemetry.timer("checksum"):
+                    file_checksum = md5_of_file(job.path)
+                # Look up its checksum if it exists and skip download if the checksum matches
+                if job.name in self.checksums.keys():
+                    expected_checksum = self.checksums[job.name]
+                    if expected_checksum == file_checksum:
+                        xbmc.log("Checksum of already-downloaded file {} matched, skipping download".format(
+                            job.name), level=xbmc.LOGDEBUG)
+                        self.verification_index.record(job.path, file_checksum)
+                        self._file_done(job, skipped=True)
+                        return
+                    self.verification_index.invalidate(job.path)
+                    xbmc.log("Calculated checksum {} did not match expected {} for file {}".format(
+                        file_checksum, expected_checksum, job.name), level=xbmc.LOGDEBUG)
+
+        # If the file didn't exist, the checksum was disabled, or the checksum didn't match, download video
+        xbmc.log("Downloading {}".format(job.url), level=xbmc.LOGDEBUG)
+        job.size, accepts_ranges = probe_url(job.url)
+        job.parts = self._existing_parts(job)
+
+        if job.size and accepts_ranges:
+            segments = split_ranges(compute_missing_ranges(job.size, job.parts), connections)
+            already_done = job.size - sum(end - start for start, end in segments)
+        else:
+            # Without a known size or Range support we can neither split nor resume, start from scratch
+            self._delete_parts(job)
+            segments = [(0, job.size)]
+            already_done = 0
+
+        with self.lock:
+            self.bytes_total += job.size or 0
+            self.bytes_done += already_done
+        if not segments:
+            xbmc.log("All parts of {} were already downloaded, joining them".format(job.name), level=xbmc.LOGDEBUG)
+            self.finalize(job)
+            return
+
+        # A file fetched in order from its first byte can be hashed as it is written
+        if job.name in self.checksums and segments[0][0] == 0:
+            job.digest = hashlib.md5()
+
+        job.pending = len(segments)
+        for start, end in segments:
+            job.parts[start] = 0
+            self._submit(job, self.fetch_segment, job, start, end)
+
+    # Parts left behind by a canceled or crashed download, as {offset: size}
+    def _existing_parts(self, job):
+        parts = {}
+        prefix = job.name + part_marker
+        for file_name in self.download_folder_files:
+            if file_name.startswith(prefix) and file_name[len(prefix):].isdigit():
+                part_path = xbmcvfs.translatePath(job.path + part_marker + file_name[len(prefix):])
+                parts[int(file_name[len(prefix):])] = xbmcvfs.Stat(part_path).st_size()
+        return parts
+
+    def _delete_parts(self, job):
+        for offset in list(job.parts):
+            xbmcvfs.delete(xbmcvfs.translatePath(job.path + part_marker + str(offset)))
+        job.parts = {}
+
+    # Fetch the [start, end) byte range of the file into its own part file
+    def fetch_segment(self, job, start, end):
+        part_path = xbmcvfs.translatePath(job.path + part_marker + str(start))
+        digest = job.digest if start == 0 else None
+        headers = {}
+        if end is not None:
+            headers["Range"] = "bytes={}-{}".format(start, end - 1)
+
+        # Segments still queued when the download is canceled don't open a connection
+        if not self.stop:
+            try:
+                with urlopen(Request(job.url, headers=headers), timeout=request_timeout) as u:
+                    if start and u.status != 206:
+                        raise IOError("server ignored the Range request for {}".format(job.name))
+                    with xbmcvfs.File(part_path, 'w') as f:
+                        while not self.stop:
+                            buffer = u.read(block_sz)
+                            if not buffer:
+                                break
+                            f.write(buffer)
+                            if digest:
+                                digest.update(buffer)
+                            job.parts[start] += len(buffer)
+                            with self.lock:
+                                self.bytes_done += len(buffer)
+                                self.bytes_fetched += len(buffer)
+                                self.current_name = job.name
+            except Exception as e:
+                job.failed = True
+                xbmc.log("[Aerial ScreenSavers] Segment {} of {} failed: {}".format(start, job.name, e),
+                         level=xbmc.LOGERROR)
+
+        with job.lock:
+            job.pending -= 1
+            last_segment = job.pending == 0
+        if last_segment and not self.stop and not job.failed:
+            self.finalize(job)
+
+    # Join the parts of a completed download into the final file
+    def finalize(self, job):
+        if job.size is not None and compute_missing_ranges(job.size, job.parts):
+            xbmc.log("[Aerial ScreenSavers] Parts of {} are incomplete, keeping them for a later resume".format(
+                job.name), level=xbmc.LOGERROR)
+            return
+
+        final_path = xbmcvfs.translatePath(job.path)
+        if xbmcvfs.exists(final_path):
+            xbmcvfs.delete(final_path)
+
+        file_checksum = None
+        if list(job.parts) == [0]:
+            # A single part covering the whole file only needs a rename
+            xbmcvfs.rename(final_path + part_marker + "0", final_path)
+            if job.digest:
+                file_checksum = job.digest.hexdigest()
+        else:
+            # Joining the parts streams every byte once, hash them on the way through
+            digest = hashlib.md5() if job.name in self.checksums else None
+            position = 0
+            with xbmcvfs.File(final_path, 'w') as out:
+                for offset in sorted(job.parts):
+                    # Parts may overlap when a resume used different segment boundaries, skip what we already have
+                    skip = position - offset
+                    if offset + job.parts[offset] > position:
+                        with xbmcvfs.File(final_path + part_marker + str(offset)) as part:
+                            if skip:
+                                part.seek(skip, 0)
+                            while True:
+                                buffer = part.readBytes(block_sz)
+                                if not buffer:
+                                    break
+                                out.write(buffer)
+                                if digest:
+                                    digest.update(buffer)
+                        position = offset + job.parts[offset]
+            self._delete_parts(job)
+            if digest:
+                file_checksum = digest.hexdigest()
+
+        if job.name in self.checksums:
+            if file_checksum is None:
+                # The part was completed in an earlier run, nothing was hashed while it was written
+                with telemetry.timer("checksum"):
+                    file_checksum = md5_of_file(final_path)
+            if file_checksum != self.checksums[job.name]:
+                xbmc.log("[Aerial ScreenSavers] Downloaded file {} has checksum {}, expected {}. Removing it".format(
+                    job.name, file_checksum, self.checksums[job.name]), level=xbmc.LOGERROR)
+                telemetry.count("checksum_mismatch")
+                xbmcvfs.delete(final_path)
+                return
+            self.verification_index.record(job.path, file_checksum)
+        self._file_done(job)
+
+    def _file_done(self, job, skipped=False):
+        with self.lock:
+            self.files_done += 1
+            self.completed.add(job.url)
+            if skipped:
+                self.files_skipped += 1
+
+    def dialogdown(self, start_time):
+        with self.lock:
+            bytes_done, bytes_total, bytes_fetched = self.bytes_done, self.bytes_total, self.bytes_fetched
+            files_done, files_total, name = self.files_done, self.files_total, self.current_name
         try:
-            percent = int(min(numblocks * blocksize * 100 / filesize, 100))
-            currently_downloaded = float(numblocks) * blocksize / (1024 * 1024)
-            kbps_speed = numblocks * blocksize / (time.time() - start_time)
+            percent = int(min(bytes_done * 100 / bytes_total, 100))
+            currently_downloaded = float(bytes_done) / (1024 * 1024)
+            # Resumed parts were not fetched now, they don't count toward the speed
+            kbps_speed = bytes_fetched / (time.time() - start_time)
             if kbps_speed > 0:
-                eta = (filesize - numblocks * blocksize) / kbps_speed
+                eta = (bytes_total - bytes_done) / kbps_speed
             else:
                 eta = 0
             kbps_speed = kbps_speed / 1024
-            total = float(filesize) / (1024 * 1024)
+            total = float(bytes_total) / (1024 * 1024)
             mbs = '%.02f MB %s %.02f MB' % (currently_downloaded, translate(32015), total)
             e = ' (%.0f Kb/s) ' % kbps_speed
             tempo = translate(32016) + ' %02d:%02d' % divmod(eta, 60)
-            dp.update(percent, f"{name} - {mbs}{e}\n{tempo}")
+            self.dp.update(percent, f"[{files_done}/{files_total}] {name} - {mbs}{e}\n{tempo}")
         except Exception:
-            percent = 100
-            dp.update(percent)
+            self.dp.update(0)
 
-        if dp.iscanceled():
+        if self.dp.iscanceled():
             self.stop = True
-            dp.close()
-            try:
-                xbmcvfs.delete(self.path)
-            except Exception:
-                xbmc.log(msg='[Aerial ScreenSavers] Could not remove file', level=xbmc.LOGERROR)
+            # Parts are kept on disk so the next run resumes instead of starting over
             xbmc.log(msg='[Aerial ScreenSavers] Download canceled', level=xbmc.LOGDEBUG)
@@ -0,0 +1,119 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import shutil
+import tarfile
+import threading
+import time
+from urllib import request
+from urllib.error import HTTPError
+
+import xbmc
+import xbmcvfs
+
+from . import telemetry
+from .commonatv import addon_path, addon_profile, atomic_write, load_json, temporary_path_for
+from .settings import get_settings
+
+# Apple's URL of the resources.tar file containing entries.json
+apple_resources_tar_url = "http://sylvan.apple.com/Aerials/resources-15.tar"
+
+# Local save location of the entries.json file containing video URLs
+local_entries_json_path = os.path.join(addon_path, "resources", "entries.json")
+
+# Validators (ETag, Last-Modified) and time of the last check against Apple, stored in the addon profile
+feed_state_path = os.path.join(addon_profile, "feed.json")
+
+# Seconds the screensaver is willing to wait for Apple before starting with the local entries.json
+refresh_budget = 3
+
+
+def _load_state():
+    return load_json(feed_state_path, {})
+
+
+def _save_state(state):
+    atomic_write(feed_state_path, json.dumps(state))
+
+
+# Fetch Apple's resources.tar if it changed and swap the entries.json it contains into place.
+# Returns True when the local entries.json was replaced
+def get_latest_entries_from_apple(force=False):
+    state = _load_state()
+    ttl = get_settings().feed_refresh_hours * 3600
+    if not force and time.time() - state.get("checked", 0) < ttl:
+        xbmc.log("Apple feed was checked less than {}s ago, using the local entries.json".format(ttl),
+                 level=xbmc.LOGDEBUG)
+        return False
+
+    # Only ask for the tarball if it changed since the copy we already have
+    headers = {}
+    if xbmcvfs.exists(local_entries_json_path):
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    xbmc.log("Checking the Apple Aerials resources.tar for changes", level=xbmc.LOGDEBUG)
+    start_time = time.time()
+    try:
+        response = request.urlopen(request.Request(apple_resources_tar_url, headers=headers), timeout=30)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        xbmc.log("Apple resources.tar did not change, keeping the local entries.json", level=xbmc.LOGDEBUG)
+        telemetry.count("feed_not_modified")
+        telemetry.measure("feed_fetch", time.time() - start_time)
+        state["checked"] = time.time()
+        _save_state(state)
+        return False
+
+    # Stream the tarball and only extract entries.json, next to the live copy so the final swap is atomic
+    replaced = False
+    tmp_entries_json_path = temporary_path_for(local_entries_json_path)
+    with response, tarfile.open(fileobj=response, mode="r|") as apple_tar:
+        for member in apple_tar:
+            if os.path.basename(member.name) == "entries.json" and member.isfile():
+                xbmc.log("Extracting entries.json from resources.tar and placing in ./resources", level=xbmc.LOGDEBUG)
+                with apple_tar.extractfile(member) as source, open(tmp_entries_json_path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(tmp_entries_json_path, local_entries_json_path)
+                replaced = True
+                break
+
+    if not replaced:
+        xbmc.log("Apple resources.tar did not contain entries.json", level=xbmc.LOGWARNING)
+    telemetry.count("feed_replaced" if replaced else "feed_without_entries")
+    telemetry.measure("feed_fetch", time.time() - start_time)
+    state = {"etag": response.headers.get("ETag"),
+             "last_modified": response.headers.get("Last-Modified"),
+             "checked": time.time()}
+    _save_state(state)
+    return replaced
+
+
+def _refresh_in_background():
+    try:
+        get_latest_entries_from_apple()
+    except Exception as e:
+        # If we hit an exception: ignore, log, and continue with the local copy
+        xbmc.log(msg="Caught an exception while retrieving Apple's resources.tar to extract entries.json: {}".format(e),
+                 level=xbmc.LOGWARNING)
+
+
+# Refresh entries.json but give up waiting after budget seconds. The refresh keeps going in the background
+# and swaps the new file in once it is done, the caller simply carries on with the local copy meanwhile
+def refresh_entries(budget=refresh_budget):
+    refresh_thread = threading.Thread(target=_refresh_in_background, daemon=True)
+    refresh_thread.start()
+    refresh_thread.join(budget)
+    if refresh_thread.is_alive():
+        xbmc.log("Apple feed refresh is taking longer than {}s, starting with the local entries.json".format(budget),
+                 level=xbmc.LOGDEBUG)
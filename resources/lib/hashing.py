@@ -0,0 +1,39 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import hashlib
+import os
+
+import xbmcvfs
+
+# Amount of data fed to the hash at a time, keeps memory use flat whatever the size of the video
+hash_block_size = 1024 * 1024
+
+
+# Compute the md5 checksum of a file without ever holding more than one block of it in memory
+def md5_of_file(path):
+    digest = hashlib.md5()
+    local_path = xbmcvfs.translatePath(path)
+    if os.path.isfile(local_path):
+        # Local files are read directly rather than through Kodi's VFS. Not memory mapped: a 4K video can be
+        # bigger than the address space of a 32-bit system
+        with open(local_path, "rb") as f:
+            while True:
+                buffer = f.read(hash_block_size)
+                if not buffer:
+                    break
+                digest.update(buffer)
+    else:
+        # Network shares (smb://, nfs://...) can only be read through Kodi's VFS
+        with xbmcvfs.File(local_path) as f:
+            while True:
+                buffer = f.readBytes(hash_block_size)
+                if not buffer:
+                    break
+                digest.update(buffer)
+    return digest.hexdigest()
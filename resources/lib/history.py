@@ -0,0 +1,76 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from .catalog import load_catalog
+from .commonatv import addon_profile, video_file_name, atomic_write, load_json
+
+# Videos played in the current round and how often each video was ever played, kept across sessions in the
+# addon profile
+play_history_path = os.path.join(addon_profile, "history.json")
+
+
+# A short fixed size id per video, so the history stays small even for large local libraries
+def _video_id(video):
+    return hashlib.blake2b(video.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class PlayHistory:
+    # The videos played since the last time every video of the playlist had its turn. The playlist skips
+    # them, so no clip comes back before all the others were shown, even over many short sessions.
+    # Apple clips are known by file name, so a clip is the same whether streamed or downloaded
+
+    def __init__(self, history_path=play_history_path, catalog=None):
+        self.history_path = history_path
+        self.catalog = catalog or load_catalog()
+        self.played = set()
+        # {id of the file name: times played}, by file name so a clip counts the same streamed or downloaded
+        self.play_counts = {}
+        self.lock = threading.Lock()
+        history = load_json(self.history_path, {})
+        self.played = set(history.get("played", []))
+        self.play_counts = history.get("play_counts", {})
+
+    # Id of a video in the round, by file name for Apple clips and by full path for other local files, which may
+    # share a file name in different folders
+    def _round_id(self, video):
+        file_name = video_file_name(video)
+        if self.catalog and self.catalog.asset_for_file(file_name) is not None:
+            return _video_id(file_name)
+        return _video_id(video)
+
+    def is_played(self, video):
+        return self._round_id(video) in self.played
+
+    def mark_played(self, video):
+        with self.lock:
+            self.played.add(self._round_id(video))
+            file_id = _video_id(video_file_name(video))
+            self.play_counts[file_id] = self.play_counts.get(file_id, 0) + 1
+            self.save()
+
+    # Times a video with this file name was played, in any folder or streamed
+    def play_count(self, file_name):
+        return self.play_counts.get(_video_id(file_name), 0)
+
+    # Every video had its turn, start a new round. With videos, only those start a new round
+    def reset(self, videos=None):
+        with self.lock:
+            if videos is None:
+                self.played = set()
+            else:
+                self.played.difference_update(self._round_id(video) for video in videos)
+            self.save()
+
+    # Called with the lock held
+    def save(self):
+        atomic_write(self.history_path, json.dumps({"played": list(self.played), "play_counts": self.play_counts}))
@@ -0,0 +1,178 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import xbmc
+import xbmcvfs
+
+from .commonatv import addon_profile, atomic_write, load_json
+
+video_extensions = ['.mp4', '.mov', '.mkv', '.avi', '.ts', '.m2ts'] # Common video extensions
+
+# Listings of the extra local folder from the last scan, stored in the addon profile
+local_folder_index_path = os.path.join(addon_profile, "localfolder.json")
+
+# Limits of a scan, so a huge or looping tree on a slow share can't hold the screensaver hostage
+scan_max_depth = 16
+scan_max_files = 50000
+scan_time_budget = 120
+# Directories listed at once, high latency network filesystems gain the most from overlapping round trips
+scan_workers = 4
+
+
+def _to_str(name):
+    # Ensure the name is a string, as listdir can sometimes return bytes
+    if not isinstance(name, str):
+        name = name.decode('utf-8', 'ignore')
+    return name
+
+
+def _dir_mtime(path):
+    try:
+        return xbmcvfs.Stat(path).st_mtime()
+    except Exception:
+        # Unknown mtime, the directory will simply be listed again
+        return 0
+
+
+# Something that identifies a directory however it was reached, to detect symlink loops
+def _dir_identity(path):
+    local_path = xbmcvfs.translatePath(path)
+    if os.path.isdir(local_path):
+        stat = os.stat(local_path)
+        return stat.st_dev, stat.st_ino
+    # Network paths (smb://, nfs://...) have no inode we can see, the depth limit protects those
+    return path.rstrip("/")
+
+
+class DirectoryWalker:
+    # Walks a directory tree breadth first on a pool of threads. list_directory(path) runs on the pool and
+    # returns (sub directory names, payload); iterating yields (path, payload) as soon as each listing is done
+
+    def __init__(self, base_path, list_directory, max_depth=scan_max_depth, time_budget=scan_time_budget,
+                 workers=scan_workers):
+        self.base_path = base_path
+        self.list_directory = list_directory
+        self.max_depth = max_depth
+        self.time_budget = time_budget
+        self.workers = workers
+        # False when the walk was cut short by a limit or by the consumer, so not every directory was seen
+        self.complete = True
+
+    def __iter__(self):
+        deadline = time.time() + self.time_budget
+        visited = set()
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def submit(path, depth):
+            identity = _dir_identity(path)
+            if identity in visited:
+                xbmc.log(f"Skipping {path}, it was already scanned through another path", level=xbmc.LOGDEBUG)
+                return
+            visited.add(identity)
+            pending[executor.submit(self.list_directory, path)] = (path, depth)
+
+        self.complete = False
+        try:
+            submit(self.base_path, 0)
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    xbmc.log(f"Scan of {self.base_path} exceeded its {self.time_budget}s budget, stopping",
+                             level=xbmc.LOGWARNING)
+                    return
+                done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, depth = pending.pop(future)
+                    try:
+                        dirs, payload = future.result()
+                    except Exception as e:
+                        xbmc.log(f"Error during recursive scan of {path}: {e}", level=xbmc.LOGERROR)
+                        continue
+                    yield path, payload
+                    if dirs and depth >= self.max_depth:
+                        xbmc.log(f"Not descending into {path}, maximum depth {self.max_depth} reached",
+                                 level=xbmc.LOGWARNING)
+                        continue
+                    for dir_name in dirs:
+                        # Construct full path for subdirectory
+                        submit(os.path.join(path, dir_name), depth + 1)
+            self.complete = True
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def _list_videos(dir_path):
+    dirs, files = xbmcvfs.listdir(dir_path)
+    videos = [_to_str(name) for name in files if os.path.splitext(_to_str(name))[1].lower() in video_extensions]
+    return [_to_str(name) for name in dirs], videos
+
+
+class LocalFolderIndex:
+    # Remembers the mtime, video files and sub directories of every directory under base_path.
+    # A rescan stats each known directory but only lists the ones whose mtime changed
+
+    def __init__(self, base_path, index_path=local_folder_index_path):
+        self.base_path = base_path
+        self.index_path = index_path
+        self.directories = {}
+        stored = load_json(self.index_path, {})
+        # An index of another folder is of no use
+        if stored.get("base") == base_path:
+            self.directories = stored.get("directories", {})
+
+    # Every video known to the index, without touching the filesystem
+    def videos(self):
+        for dir_path, entry in self.directories.items():
+            for file_name in entry["files"]:
+                yield os.path.join(dir_path, file_name)
+
+    # Runs on the walker's pool: reuse the stored listing when the directory's mtime didn't change
+    def _list_directory(self, dir_path):
+        mtime = _dir_mtime(dir_path)
+        entry = self._previous.get(dir_path)
+        if entry and mtime and entry["mtime"] == mtime:
+            return entry["dirs"], (entry, [])
+        dirs, videos = _list_videos(dir_path)
+        known_files = set(entry["files"]) if entry else set()
+        new_videos = [os.path.join(dir_path, name) for name in videos if name not in known_files]
+        return dirs, ({"mtime": mtime, "files": videos, "dirs": dirs}, new_videos)
+
+    # Bring the index up to date with the folder, yielding the videos that were not known before as they are
+    # found. Sub directories are checked even when their parent didn't change
+    def scan(self, max_files=scan_max_files):
+        self._previous = self.directories
+        directories = {}
+        walker = DirectoryWalker(self.base_path, self._list_directory)
+        walk = iter(walker)
+        found = 0
+        try:
+            for dir_path, (entry, new_videos) in walk:
+                directories[dir_path] = entry
+                found += len(entry["files"])
+                yield from new_videos
+                if found >= max_files:
+                    xbmc.log(f"Scan of {self.base_path} reached {max_files} videos, stopping", level=xbmc.LOGWARNING)
+                    break
+        finally:
+            walk.close()
+            if walker.complete:
+                self.directories = directories
+            else:
+                # Directories the walk didn't reach keep their previous listing
+                self.directories = dict(self._previous, **directories)
+
+    def save(self):
+        atomic_write(self.index_path, json.dumps({"base": self.base_path, "directories": self.directories}))
@@ -6,79 +6,155 @@
    See LICENSE for more information.
 """
 
+import shutil
+
 import xbmc
 import xbmcvfs
 
-from .commonatv import dialog, addon, translate, find_ranked_key_in_dict, compute_block_key_list
+from .commonatv import dialog, translate
 from .downloader import Downloader
-from .playlist import AtvPlaylist
+from .history import PlayHistory
+from .playlist import AtvPlaylist, invalidate_playlist_snapshot
+from .settings import get_settings, known_locations
+from .storage import StorageManager
 
 # Array of "All" plus each unique "accessibilityLabel" in entries.json
 # Used in a popup to allow the user to choose what to download
 # Sort the locations list alphabetically and in place
-locations = ["All"] + sorted(["Africa and the Middle East", "Africa Night", "Alaskan Jellies", "Antarctica",
-                              "Atlantic Ocean to Spain and France", "Australia", "Barracuda", "Bumpheads",
-                              "California Dolphins", "California Kelp Forest", "California to Vegas", "Caribbean Day",
-                              "Caribbean", "China", "Costa Rica Dolphins", "Cownose Rays", "Dubai", "Grand Canyon",
-                              "Gray Reef Sharks", "Greenland", "Hawaii", "Hong Kong", "Humpback Whale", "Iceland",
-                              "Iran and Afghanistan", "Ireland to Asia", "Italy to Asia", "Jacks", "Kelp",
-                              "Korea and Japan Night", "Liwa", "London", "Los Angeles", "New York Night", "New York",
-                              "New Zealand", "Nile Delta", "North America Aurora", "Palau Coral", "Palau Jellies",
-                              "Patagonia", "Red Sea Coral", "Sahara and Italy", "San Francisco", "Scotland",
-                              "Sea Stars", "Seals", "South Africa to North Asia", "Southern California to Baja",
-                              "Tahiti Waves", "West Africa to the Alps", "Yosemite"])
+locations = ["All"] + known_locations
+# Qualities a location can be downloaded in instead of the one of the video settings, by URL key
+quality_labels = {"url-4K-HDR": "4K HDR", "url-4K-SDR": "4K SDR", "url-1080-HDR": "1080p HDR",
+                  "url-1080-SDR": "1080p SDR", "url-1080-H264": "1080p H264"}
+
+
+# Free bytes where folder is, None when Kodi can't tell (e.g. network shares)
+def free_space(folder):
+    try:
+        return shutil.disk_usage(xbmcvfs.translatePath(folder)).free
+    except OSError:
+        return None
+
+
+# Show how much the download will take and what makes room for it, and let the user go ahead or not
+def confirm_download(plan, download_folder, budget):
+    lines = ["{} {}".format(translate(32154), len(plan.downloads)),
+             "{} {:.0f} MB".format(translate(32155), plan.download_size() / 1000 / 1000)]
+    if plan.unknown:
+        lines.append("{} {}".format(translate(32156), plan.unknown))
+    if plan.evictions:
+        lines.append("{} {} ({:.0f} MB)".format(translate(32161), len(plan.evictions),
+                                                plan.eviction_size() / 1000 / 1000))
+    if plan.skipped:
+        lines.append("{} {}".format(translate(32163), len(plan.skipped)))
+    if budget:
+        lines.append("{} {:.0f} / {:.0f} MB".format(translate(32162), plan.projected_size / 1000 / 1000,
+                                                   budget / 1000 / 1000))
+    free = free_space(download_folder)
+    if free is not None:
+        lines.append("{} {:.0f} MB".format(translate(32157), free / 1000 / 1000))
+    lines.append(translate(32158))
+    return dialog.yesno(translate(32000), "\n".join(lines))
+
+
+# The ranked URL keys for a location downloaded in the quality of key: that one, then the others of the video
+# settings for the scenes that don't have it
+def override_key_list(key, block_key_list):
+    return [key] + [other for other in block_key_list if other != key]
+
+
+# Let the user pick, among the chosen locations, some to download in another quality than the video settings.
+# Returns {location: ranked URL keys}
+def choose_quality_overrides(chosen_locations, block_key_list):
+    if not dialog.yesno(translate(32000), translate(32164)):
+        return {}
+    overridden_indexes = dialog.multiselect(translate(32165), chosen_locations)
+    if not overridden_indexes:
+        return {}
+    quality_index = dialog.select(translate(32166), list(quality_labels.values()))
+    if quality_index < 0:
+        return {}
+    key_list = override_key_list(list(quality_labels)[quality_index], block_key_list)
+    return {chosen_locations[index]: key_list for index in overridden_indexes}
+
+
+# The URLs of the chosen locations in their quality, each video once, in the download order of the settings
+def build_download_list(catalog, chosen_locations, block_key_list, location_key_lists, storage):
+    download_list = []
+    seen = set()
+    # Look up the chosen locations in the catalog index instead of scanning every asset
+    for location in chosen_locations:
+        key_list = location_key_lists.get(location, block_key_list)
+        for asset in catalog.by_location.get(location, []):
+            # Get the URL of the asset in the preferred quality, already rewritten to HTTP
+            url = asset.url_for(key_list)
+
+            # URL could be empty if the JSON didn't have a matching quality, so skip adding it in that case
+            if not url:
+                xbmc.log("The needed quality does not exist for current location {}, skipping".format(
+                    asset.location), level=xbmc.LOGDEBUG)
+            elif url not in seen:
+                seen.add(url)
+                download_list.append(url)
+
+    storage.probe_sizes(download_list)
+
+    def size_of(url):
+        # Videos of unknown size go last
+        return storage.sizes.get(url.split("/")[-1], float("inf"))
+
+    download_order = get_settings().download_order
+    if download_order == 0:
+        # The first videos are playable sooner
+        download_list.sort(key=size_of)
+    elif download_order == 1:
+        download_list.sort(key=lambda url: (-storage.history.play_count(url.split("/")[-1]), size_of(url)))
+    return download_list
 
 
 # Parse the JSON to get a list of URLs and download the files to the download folder
 def offline():
     # NOTE: the download folder must be saved by pushing OK in the settings dialog before this will succeed
-    if addon.getSetting("download-folder") and xbmcvfs.exists(addon.getSetting("download-folder")):
-        # Present a popup to the user and allow them to select a single location to download, or all
-        locations_chosen_index = dialog.select(translate(32014), locations)
-        if locations_chosen_index > -1:
-            # Initialize the Playlist class, and get the JSON containing URLs
-            top_level_json = AtvPlaylist().get_playlist_json()
+    settings = get_settings()
+    if settings.download_folder and xbmcvfs.exists(settings.download_folder):
+        # Present a popup to the user and allow them to select the locations to download, or all
+        locations_chosen_indexes = dialog.multiselect(translate(32014), locations)
+        if locations_chosen_indexes:
+            # Initialize the Playlist class, and get the catalog containing URLs
+            catalog = AtvPlaylist().get_catalog()
             download_list = []
-            if top_level_json:
-
-                # Parse the H264, HDR, and 4K settings to determine URL preference.
-                block_key_list = compute_block_key_list(addon.getSettingBool("enable-4k"),
-                                                        addon.getSettingBool("enable-hdr"),
-                                                        addon.getSettingBool("enable-hevc"))
-
-                # Top-level JSON has assets array, initialAssetCount, categories, version.
-                # Inspect each block in assets, the other sections are irrelevant to us
-                for block in top_level_json["assets"]:
-                    # Each block contains a location whose name is stored in accessibilityLabel. These may recur
-                    # Get the location from the current block
-                    location = block["accessibilityLabel"]
-
-                    # If the chosen location was a specific place and not All, inspect each block
-                    if not locations[locations_chosen_index] == "All":
-                        # Exit block processing early if the location didn't match our preference.
-                        # This prevents the location from being added to the download list
-                        if not locations[locations_chosen_index] == location:
-                            xbmc.log("Current location {} is not chosen location, skipping download".format(location),
-                                     level=xbmc.LOGDEBUG)
-                            continue
-
-                    # Get the URL from the current block to download
-                    url = find_ranked_key_in_dict(block, block_key_list)
-
-                    # URL could be empty if the JSON didn't have a matching quality, so skip adding it in that case
-                    if url:
-                        # If the URL contains HTTPS, we need revert to HTTP to avoid bad SSL cert
-                        # NOTE: Old Apple URLs were HTTP, new URLs are HTTPS with a bad cert
-                        if "https" in url:
-                            url = url.replace("https://", "http://")
-                        download_list.append(url)
-                    else:
-                        xbmc.log("The needed quality does not exist for current location {}, skipping".format(location),
-                                 level=xbmc.LOGDEBUG)
-
-            # call downloader if the download_list has been populated
+            if catalog:
+                if 0 in locations_chosen_indexes:
+                    chosen_locations = catalog.locations()
+                else:
+                    chosen_locations = [locations[index] for index in locations_chosen_indexes]
+
+                # URL preference computed from the H264, HDR, and 4K settings, or chosen for some locations
+                block_key_list = settings.block_key_list
+                location_key_lists = choose_quality_overrides(chosen_locations, block_key_list)
+
+                budget = settings.download_budget_gb * 1000 * 1000 * 1000
+                storage = StorageManager(settings.download_folder, budget, block_key_list, catalog,
+                                         PlayHistory(catalog=catalog), location_key_lists=location_key_lists)
+                download_list = build_download_list(catalog, chosen_locations, block_key_list, location_key_lists,
+                                                    storage)
+
+            # call downloader if the download_list has been populated and the user agrees to the space it needs
             if download_list:
-                Downloader().download_videos_from_urls(download_list)
+                plan = storage.plan(download_list)
+                if not confirm_download(plan, settings.download_folder, budget):
+                    return
+                # Videos already downloaded stay in the list, the downloader verifies them
+                urls = [url for url in download_list if url not in plan.skipped]
+                if not urls:
+                    # Every video is over the size limit
+                    dialog.ok(translate(32000), "{} {}".format(translate(32163), len(plan.skipped)))
+                    storage.apply(plan, set())
+                    return
+                completed = Downloader().download_videos_from_urls(urls)
+                # Replaced videos only go once their replacement is complete
+                storage.apply(plan, completed)
+                # Downloaded files replace their streamed URLs, have the service compute the playlist again
+                invalidate_playlist_snapshot()
             else:
                 dialog.ok(translate(32000), translate(32012))
     else:
@@ -0,0 +1,30 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import xbmc
+
+
+class AtvPlayer(xbmc.Player):
+    # Player that reports clip starts and ends through callbacks, so nothing has to poll isPlaying()
+
+    def __init__(self, on_started, on_finished):
+        super().__init__()
+        self.on_started = on_started
+        self.on_finished = on_finished
+
+    def onAVStarted(self):
+        self.on_started()
+
+    def onPlayBackEnded(self):
+        self.on_finished(error=False, stopped=False)
+
+    def onPlayBackStopped(self):
+        self.on_finished(error=False, stopped=True)
+
+    def onPlayBackError(self):
+        self.on_finished(error=True, stopped=False)
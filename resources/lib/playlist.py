@@ -8,49 +8,219 @@
 
 import json
 import os
-import tarfile
-from random import shuffle
-from urllib import request
+import threading
+import time
+from random import randrange
 
 import xbmc
 import xbmcvfs
 
-from .commonatv import addon, addon_path, find_ranked_key_in_dict, compute_block_key_list
+from . import telemetry
+from .catalog import load_catalog
+from .commonatv import addon_profile, atomic_write, load_json
+from .feed import refresh_entries
+from .localfolder import LocalFolderIndex
+from .settings import get_settings
 
-# Apple's URL of the resources.tar file containing entries.json
-apple_resources_tar_url = "http://sylvan.apple.com/Aerials/resources-15.tar"
+# Ready-made playlist computed by the background service, loaded by the screensaver instead of building one
+playlist_snapshot_path = os.path.join(addon_profile, "playlist.json")
 
-# Local temporary save location of the Apple TAR file
-apple_local_tar_path = os.path.join(addon_path, "resources.tar")
+# Local hours at which the time-of-day smart mode switches to night scenes and back to day scenes
+dusk_hour = 19
+dawn_hour = 7
+# Scenes that suit each value of the time-of-day setting: all, day only, night only, smart mode
+time_of_day_filters = [None, ("day", "any"), ("night", "any"), None]
 
-# Local save location of the entries.json file containing video URLs
-local_entries_json_path = os.path.join(addon_path, "resources", "entries.json")
 
+def save_playlist_snapshot(playlist):
+    atomic_write(playlist_snapshot_path, json.dumps(list(playlist or [])))
 
-# Fetch the TAR file containing the latest entries.json and overwrite the local copy
-def get_latest_entries_from_apple():
-    xbmc.log("Downloading the Apple Aerials resources.tar to disk", level=xbmc.LOGDEBUG)
 
-    # Alternatively, just use the HTTP link instead of HTTPS to download the TAR locally
-    request.urlretrieve(apple_resources_tar_url, apple_local_tar_path)
-    # https://www.tutorialspoint.com/How-are-files-extracted-from-a-tar-file-using-Python
-    apple_tar = tarfile.open(apple_local_tar_path)
-    xbmc.log("Extracting entries.json from resources.tar and placing in ./resources", level=xbmc.LOGDEBUG)
-    apple_tar.extract("entries.json", os.path.join(addon_path, "resources"))
+# Return the snapshotted playlist, or None if there is none and the playlist has to be computed live
+def load_playlist_snapshot():
+    playlist = load_json(playlist_snapshot_path, None)
+    if not playlist:
+        return None
+    return new_playlist(playlist)
 
-    apple_tar.close()
-    xbmc.log("Deleting resources.tar now that we've grabbed entries.json from it", level=xbmc.LOGDEBUG)
-    os.remove(apple_local_tar_path)
+
+# Drop the snapshot when whatever it was computed from (settings, downloads) changed
+def invalidate_playlist_snapshot():
+    if xbmcvfs.exists(playlist_snapshot_path):
+        xbmcvfs.delete(playlist_snapshot_path)
+
+
+class ShuffledPlaylist:
+    # Hands out videos in random order without shuffling the whole list upfront: each pick swaps a random video
+    # not played yet this round into place (Fisher-Yates one step at a time), so the cost is per clip played
+    # rather than per video known. Videos added while it is consumed, e.g. by a background scan, join the ones
+    # not played yet. When every video was handed out a new round starts.
+    # With a PlayHistory, videos already played this round in an earlier session are skipped, and with prefer,
+    # videos for which it returns True (e.g. local files) are more likely to be picked first
+
+    def __init__(self, videos=()):
+        self.videos = []
+        self.known = set()
+        # videos[:position] were handed out this round, videos[position:picked] are the upcoming picks
+        # already drawn by peek(), videos[picked:end] are left to draw and videos[end:] were skipped
+        # because the history says they were played this round
+        self.position = 0
+        self.picked = 0
+        self.end = 0
+        self.history = None
+        self.prefer = None
+        self.lock = threading.Lock()
+        for video in videos:
+            self.add(video)
+
+    def use_history(self, history, prefer=None):
+        with self.lock:
+            self.history = history
+            self.prefer = prefer
+
+    # Add a video unless it is already in the playlist. Returns True if it was added
+    def add(self, video):
+        with self.lock:
+            if video in self.known:
+                return False
+            self.known.add(video)
+            # Goes with the videos left to draw, in front of the skipped ones
+            self.videos.append(video)
+            self.videos[self.end], self.videos[-1] = self.videos[-1], self.videos[self.end]
+            self.end += 1
+            return True
+
+    def __len__(self):
+        return len(self.videos)
+
+    # Iterates over every video, in no particular order
+    def __iter__(self):
+        return iter(list(self.videos))
+
+    # Called with the lock held: the index of a random video left to draw, or None if there is none left
+    def _candidate(self, index):
+        while index < self.end:
+            swap = randrange(index, self.end)
+            video = self.videos[swap]
+            if self.history is None or not self.history.is_played(video):
+                return swap
+            # Played in an earlier session this round, set it aside until the next round
+            self.end -= 1
+            self.videos[swap], self.videos[self.end] = self.videos[self.end], video
+        return None
+
+    # Called with the lock held: draw the pick at index, unless peek() already did. Returns False if
+    # every video of the round was drawn
+    def _draw(self, index):
+        if index < self.picked:
+            return True
+        swap = self._candidate(index)
+        if swap is None:
+            return False
+        self.videos[index], self.videos[swap] = self.videos[swap], self.videos[index]
+        if self.prefer and not self.prefer(self.videos[index]):
+            # Give a preferred video a second chance, drawn from after the first pick so setting played videos
+            # aside can't move it. The first pick goes back to the round in place of the other one
+            other = self._candidate(index + 1)
+            if other is not None and self.prefer(self.videos[other]):
+                self.videos[index], self.videos[other] = self.videos[other], self.videos[index]
+        self.picked = index + 1
+        return True
+
+    def next_video(self):
+        with self.lock:
+            if not self._draw(self.position):
+                # Every video was played, start a new round
+                self.position = 0
+                self.picked = 0
+                self.end = len(self.videos)
+                if self.history:
+                    self.history.reset(self.videos)
+                self._draw(self.position)
+            self.position += 1
+            return self.videos[self.position - 1]
+
+    # The next count videos next_video() will return, without handing them out. Stops at the end of the round
+    def peek(self, count):
+        with self.lock:
+            index = self.position
+            while index < self.position + count and self._draw(index):
+                index += 1
+            return self.videos[self.position:index]
+
+
+def current_time_of_day():
+    hour = time.localtime().tm_hour
+    return "day" if dawn_hour <= hour < dusk_hour else "night"
+
+
+class TimeOfDayPlaylist:
+    # The time-of-day smart mode: a ShuffledPlaylist of the videos that suit the day and one of those that suit
+    # the night, built as videos are added. Each pick comes from the one of the current time, so switching at
+    # dusk is a lookup rather than a rebuild. Videos that suit either time (space, extra local files) are in both
+
+    def __init__(self, videos=(), time_of_day_for=None):
+        self.playlists = {"day": ShuffledPlaylist(), "night": ShuffledPlaylist()}
+        self.known = set()
+        if time_of_day_for is None:
+            catalog = load_catalog()
+            time_of_day_for = catalog.time_of_day_for if catalog else (lambda video: "any")
+        self.time_of_day_for = time_of_day_for
+        for video in videos:
+            self.add(video)
+
+    def use_history(self, history, prefer=None):
+        for playlist in self.playlists.values():
+            playlist.use_history(history, prefer)
+
+    def add(self, video):
+        if video in self.known:
+            return False
+        self.known.add(video)
+        time_of_day = self.time_of_day_for(video)
+        for window, playlist in self.playlists.items():
+            if time_of_day in (window, "any"):
+                playlist.add(video)
+        return True
+
+    # The playlist of the current time, or the other one if nothing suits the current time
+    def current(self):
+        window = current_time_of_day()
+        if self.playlists[window]:
+            return self.playlists[window]
+        return self.playlists["night" if window == "day" else "day"]
+
+    def __len__(self):
+        return len(self.known)
+
+    def __iter__(self):
+        return iter(list(self.known))
+
+    def next_video(self):
+        return self.current().next_video()
+
+    def peek(self, count):
+        return self.current().peek(count)
+
+
+# An empty playlist of the kind the time-of-day setting asks for
+def new_playlist(videos=()):
+    if get_settings().time_of_day == 3:
+        return TimeOfDayPlaylist(videos)
+    return ShuffledPlaylist(videos)
 
 
 class AtvPlaylist:
-    def __init__(self, ):
-        self.playlist = []
-        self.top_level_json = {} # Initialize to empty dict
-        # Set a class variable as the Bool response of our Setting.
-        self.force_offline = addon.getSettingBool("force-offline")
-        self.extra_local_folder_only = addon.getSettingBool("only-extra-local-folder")
-        extra_folder_path = addon.getSetting("extra-local-folder")
+    def __init__(self, refresh_feed=True, wait_for_scan=False):
+        self.playlist = new_playlist()
+        # When False, the extra local folder is rescanned in the background after the playlist is returned
+        self.wait_for_scan = wait_for_scan
+        self.catalog = None
+        # All the settings we need, read from Kodi once
+        self.settings = get_settings()
+        self.force_offline = self.settings.force_offline
+        self.extra_local_folder_only = self.settings.only_extra_local_folder
+        extra_folder_path = self.settings.extra_local_folder
 
         # Only try to load Apple's JSON if we're not in "extra local folder only" mode
         # and a valid extra local folder is actually provided.
@@ -60,136 +230,105 @@ class AtvPlaylist:
         if should_load_apple_json:
             if not xbmc.getCondVisibility("Player.HasMedia"):
                 # If we're not forcing offline state and not using custom JSON:
-                if not self.force_offline and addon.getSettingBool("get-videos-from-apple"):
-                    try:
-                        # Update local JSON with the copy from Apple
-                        get_latest_entries_from_apple()
-                    except Exception:
-                        # If we hit an exception: ignore, log, and continue
-                        xbmc.log(msg="Caught an exception while retrieving Apple's resources.tar to extract entries.json",
-                                 level=xbmc.LOGWARNING)
-                # Regardless of if we grabbed new Apple JSON, hit an exception, or are in offline mode, load the local copy
-                # Also ensure the local_entries_json_path exists before trying to open it
-                if xbmcvfs.exists(local_entries_json_path):
-                    with open(local_entries_json_path, "r") as f:
-                        self.top_level_json = json.loads(f.read())
-                else:
-                    xbmc.log(msg="Local entries.json not found at {}".format(local_entries_json_path), level=xbmc.LOGWARNING)
-            # If Player.HasMedia, top_level_json remains empty as per original logic
+                if refresh_feed and not self.force_offline and self.settings.get_videos_from_apple:
+                    # Update local JSON with the copy from Apple, without waiting longer than the refresh budget
+                    refresh_entries()
+                # Regardless of if we grabbed new Apple JSON, hit an exception, or are in offline mode, load the local
+                # copy. The compiled catalog is reused as long as entries.json didn't change
+                self.catalog = load_catalog()
+            # If Player.HasMedia, catalog remains empty as per original logic
         else:
             xbmc.log("Skipping Apple JSON load due to 'only-extra-local-folder' setting and valid path.", level=xbmc.LOGDEBUG)
 
-    def _scan_directory_recursively(self, base_path):
-        video_extensions = ['.mp4', '.mov', '.mkv', '.avi', '.ts', '.m2ts'] # Common video extensions
-        found_videos = []
+    # Add the videos streamed by a scan of the extra local folder to the playlist, then save its index
+    def _add_scanned_videos(self, local_index, scan):
         try:
-            dirs, files = xbmcvfs.listdir(base_path)
-            for file_name in files:
-                # Ensure file_name is a string, as listdir can sometimes return unicode
-                if not isinstance(file_name, str):
-                    file_name = file_name.decode('utf-8', 'ignore')
-                if os.path.splitext(file_name)[1].lower() in video_extensions:
-                    # xbmcvfs.listdir returns names, not full paths. Need to join.
-                    # Ensure base_path also doesn't have trailing slash issues with os.join
-                    # However, Kodi paths are usually well-formed with xbmcvfs.
-                    full_path = os.path.join(base_path, file_name)
-                    found_videos.append(full_path)
-            
-            for dir_name in dirs:
-                # Ensure dir_name is a string
-                if not isinstance(dir_name, str):
-                    dir_name = dir_name.decode('utf-8', 'ignore')
-                # Construct full path for subdirectory
-                sub_dir_path = os.path.join(base_path, dir_name)
-                # Recursive call
-                found_videos.extend(self._scan_directory_recursively(sub_dir_path))
+            with telemetry.timer("folder_scan"):
+                for video_path in scan:
+                    if self.playlist.add(video_path):
+                        telemetry.count("folder_scan_new_videos")
+                        xbmc.log(f"Added local video to playlist: {video_path}", level=xbmc.LOGDEBUG)
+            local_index.save()
         except Exception as e:
-            xbmc.log(f"Error during recursive scan of {base_path}: {e}", level=xbmc.LOGERROR)
-        return found_videos
+            xbmc.log(f"Error scanning extra local folder: {local_index.base_path}. Error: {e}", level=xbmc.LOGERROR)
 
-    def get_playlist_json(self):
-        return self.top_level_json
+    def get_catalog(self):
+        return self.catalog
 
     def compute_playlist_array(self):
-        extra_folder_path = addon.getSetting("extra-local-folder")
+        with telemetry.timer("playlist_build"):
+            return self._compute_playlist_array()
+
+    def _compute_playlist_array(self):
+        extra_folder_path = self.settings.extra_local_folder
         # Determine if we should exclusively use the extra local folder
         use_only_extra_local = self.extra_local_folder_only and extra_folder_path and xbmcvfs.exists(extra_folder_path)
 
-        if not use_only_extra_local and self.top_level_json:
-            # Parse the H264, HDR, and 4K settings to determine URL preference.
-            block_key_list = compute_block_key_list(addon.getSettingBool("enable-4k"),
-                                                    addon.getSettingBool("enable-hdr"),
-                                                    addon.getSettingBool("enable-hevc"))
-
-            # Top-level JSON has assets array, initialAssetCount, version. Inspect each block in "assets"
-            for block in self.top_level_json["assets"]:
-                # Each block contains a location/scene whose name is stored in accessibilityLabel. These may recur
-                # Retrieve the location name
-                location = block["accessibilityLabel"]
-                try:
-                    # Get the corresponding setting Bool by adding "enable-" + lowercase + no whitespace
-                    current_location_enabled = addon.getSettingBool("enable-" + location.lower().replace(" ", ""))
-                except TypeError:
-                    xbmc.log("Location {} did not have a matching enable/disable setting".format(location),
-                             level=xbmc.LOGDEBUG)
-                    # Leave the location in the rotation if we couldn't find a corresponding setting disabling it
-                    current_location_enabled = True
-
-                # Skip the rest of the loop if the current block's location setting has been explicitly disabled
-                if not current_location_enabled:
-                    continue
+        if not use_only_extra_local and self.catalog:
+            # URL preference computed from the H264, HDR, and 4K settings
+            block_key_list = self.settings.block_key_list
+
+            # Skip the locations whose setting has been explicitly disabled
+            enabled_locations = [location for location in self.catalog.by_location
+                                 if self.settings.location_enabled(location)]
 
-                # Get the URL from the current block to download
-                url = find_ranked_key_in_dict(block, block_key_list)
+            # List the download folder once, local availability of each asset is then a set lookup
+            # instead of two stat calls per asset (which are network round trips on SMB/NFS shares)
+            local_download_path = self.settings.download_folder
+            downloaded_files = set()
+            if local_download_path:
+                downloaded_files = set(xbmcvfs.listdir(local_download_path)[1])
+
+            # Only the scenes that suit the time-of-day setting, from the catalog's index
+            times_of_day = time_of_day_filters[self.settings.time_of_day]
+            for asset in self.catalog.assets_for_locations(enabled_locations, times_of_day):
+                location = asset.location
+                # Get the URL of the asset in the preferred quality, already rewritten to HTTP
+                url = asset.url_for(block_key_list)
 
                 # If the URL is empty/None, skip the rest of the loop
                 if not url:
                     continue
 
-                # If the URL contains HTTPS, we need revert to HTTP to avoid bad SSL cert
-                # NOTE: Old Apple URLs were HTTP, new URLs are HTTPS with a bad cert
-                if "https" in url:
-                    url = url.replace("https://", "http://")
-
                 # Get just the file's name, without the Apple HTTP URL part
                 file_name = url.split("/")[-1]
 
                 # By default, we assume a local copy of the file doesn't exist
                 exists_on_disk = False
-                # Inspect the disk to see if the file exists in the download location
-                local_download_path = addon.getSetting("download-folder")
-                if local_download_path and xbmcvfs.exists(local_download_path):
+                # Check the listing of the download location to see if the file exists there
+                if file_name in downloaded_files:
                     local_file_path = os.path.join(local_download_path, file_name)
-                    if xbmcvfs.exists(local_file_path):
-                        # Mark that the file exists on disk
-                        exists_on_disk = True
-                        # Overwrite the network URL with the local path to the file
-                        url = local_file_path
-                        xbmc.log("Video available locally (download folder), path is: {}".format(local_file_path), level=xbmc.LOGDEBUG)
+                    # Mark that the file exists on disk
+                    exists_on_disk = True
+                    # Overwrite the network URL with the local path to the file
+                    url = local_file_path
+                    xbmc.log("Video available locally (download folder), path is: {}".format(local_file_path), level=xbmc.LOGDEBUG)
 
                 # If the file exists locally or we're not in offline mode, add it to the playlist
                 if exists_on_disk or not self.force_offline:
                     xbmc.log("Adding Apple video for location {} to playlist".format(location), level=xbmc.LOGDEBUG)
-                    self.playlist.append(url)
-
-            # Shuffle after adding Apple's videos if any were added
-            if self.playlist:
-                shuffle(self.playlist)
+                    self.playlist.add(url)
 
         # Add files from the extra local folder
         # This part runs if 'use_only_extra_local' is true, or if it's false and we're mixing.
-        extra_folder_path = addon.getSetting("extra-local-folder")
         if extra_folder_path and xbmcvfs.exists(extra_folder_path):
-            xbmc.log(f"Scanning extra local folder (recursively): {extra_folder_path}", level=xbmc.LOGDEBUG)
             try:
-                local_videos_found = self._scan_directory_recursively(extra_folder_path)
-                if local_videos_found:
-                    for video_path in local_videos_found:
-                        if video_path not in self.playlist:
-                            self.playlist.append(video_path)
-                            xbmc.log(f"Added local video to playlist: {video_path}", level=xbmc.LOGDEBUG)
-                    if self.playlist: # Shuffle if any videos are present (Apple's or local)
-                        shuffle(self.playlist)
+                # Start from the videos of the last index, the scan streams in the ones it finds on top
+                local_index = LocalFolderIndex(extra_folder_path)
+                for video_path in local_index.videos():
+                    self.playlist.add(video_path)
+                xbmc.log(f"Scanning extra local folder (recursively): {extra_folder_path}", level=xbmc.LOGDEBUG)
+                scan = local_index.scan()
+                if self.wait_for_scan:
+                    self._add_scanned_videos(local_index, scan)
+                else:
+                    # With nothing to play yet, playback can start as soon as the scan finds a first video
+                    if not self.playlist:
+                        for video_path in scan:
+                            self.playlist.add(video_path)
+                            break
+                    # The rest of the scan carries on in the background, its videos join the ones not played yet
+                    threading.Thread(target=self._add_scanned_videos, args=(local_index, scan), daemon=True).start()
             except Exception as e:
                 xbmc.log(f"Error scanning or listing files in extra local folder: {extra_folder_path}. Error: {e}", level=xbmc.LOGERROR)
 
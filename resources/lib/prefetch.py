@@ -0,0 +1,152 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import threading
+import time
+from urllib import request
+
+import xbmc
+import xbmcvfs
+
+from . import telemetry
+from .commonatv import addon_profile, atomic_write, load_json
+from .downloader import block_sz
+
+# Streamed Apple clips fetched ahead of time, and when each of them was last played
+prefetch_cache_folder = os.path.join(addon_profile, "cache")
+prefetch_index_path = os.path.join(addon_profile, "cache.json")
+
+
+def _file_name(url):
+    return url.split("/")[-1]
+
+
+class PrefetchCache:
+    # Downloads the next clips of the playlist to a folder in the addon profile while the current one plays,
+    # one at a time so the live stream keeps most of the bandwidth. Once the folder would grow past max_bytes,
+    # the least recently played clips are deleted to make room
+
+    def __init__(self, max_bytes, folder=prefetch_cache_folder, index_path=prefetch_index_path):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.index_path = index_path
+        # {file name: time it was last played or downloaded}
+        self.last_used = load_json(self.index_path, {})
+        self.lock = threading.Lock()
+        self.wanted = []
+        # Clips Kodi has queued or is playing, never evicted
+        self.in_use = set()
+        self.changed = threading.Condition(self.lock)
+        self.stopped = False
+        self.thread = None
+        # Called with (bytes, seconds) after each fetch, to measure the throughput from Apple
+        self.on_fetched = None
+
+    def path_for(self, url):
+        return os.path.join(self.folder, _file_name(url))
+
+    # The cached copy of url if there is one, url itself otherwise
+    def resolve(self, url):
+        if url.startswith("http") and os.path.isfile(self.path_for(url)):
+            return self.path_for(url)
+        return url
+
+    # Mark the cached copy of url as just played, so it is the last to be evicted
+    def touch(self, url):
+        if not os.path.isfile(self.path_for(url)):
+            return
+        with self.lock:
+            self.last_used[_file_name(url)] = time.time()
+            self.save()
+
+    # Replace the clips to fetch with urls, in order. Clips already cached or not streamed are ignored.
+    # in_use are the clips queued in Kodi, which must stay in the cache
+    def prefetch(self, urls, in_use=()):
+        with self.lock:
+            self.in_use = {_file_name(path) for path in in_use}
+            self.wanted = [url for url in urls if url.startswith("http") and not os.path.isfile(self.path_for(url))]
+            self.changed.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.changed.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.wanted and not self.stopped:
+                    self.changed.wait()
+                if self.stopped:
+                    return
+                url = self.wanted.pop(0)
+            try:
+                self._fetch(url)
+            except Exception as e:
+                xbmc.log(f"[Aerial Screensaver] Could not prefetch {url}: {e}", level=xbmc.LOGWARNING)
+
+    def _fetch(self, url):
+        path = self.path_for(url)
+        if os.path.isfile(path):
+            return
+        if not os.path.isdir(self.folder):
+            xbmcvfs.mkdirs(self.folder)
+        with request.urlopen(url, timeout=30) as response:
+            size = int(response.headers.get("Content-Length") or 0)
+            if not self._make_room(size):
+                xbmc.log(f"[Aerial Screensaver] No room in the prefetch cache for {url}", level=xbmc.LOGDEBUG)
+                return
+            xbmc.log(f"[Aerial Screensaver] Prefetching {url}", level=xbmc.LOGDEBUG)
+            start_time = time.time()
+            fetched = 0
+            # Written under another name so a half fetched clip is never played
+            with open(path + ".part", "wb") as f:
+                while not self.stopped:
+                    buffer = response.read(block_sz)
+                    if not buffer:
+                        break
+                    f.write(buffer)
+                    fetched += len(buffer)
+        if self.stopped:
+            os.remove(path + ".part")
+            return
+        os.replace(path + ".part", path)
+        telemetry.measure("prefetch_throughput", fetched / max(time.time() - start_time, 0.001))
+        if self.on_fetched:
+            self.on_fetched(fetched, time.time() - start_time)
+        # A fresh clip counts as used, so it isn't the first to go
+        self.touch(url)
+
+    # Delete the least recently used clips until size more bytes fit under max_bytes.
+    # Returns False if that isn't possible without deleting a clip in use
+    def _make_room(self, size):
+        files = {name: os.path.getsize(os.path.join(self.folder, name)) for name in os.listdir(self.folder)}
+        total = sum(files.values())
+        if total + size <= self.max_bytes:
+            return True
+        with self.lock:
+            candidates = sorted((name for name in files if name not in self.in_use),
+                                key=lambda name: self.last_used.get(name, 0))
+            for name in candidates:
+                if total + size <= self.max_bytes:
+                    break
+                xbmc.log(f"[Aerial Screensaver] Evicting {name} from the prefetch cache", level=xbmc.LOGDEBUG)
+                os.remove(os.path.join(self.folder, name))
+                total -= files[name]
+                self.last_used.pop(name, None)
+            self.save()
+        return total + size <= self.max_bytes
+
+    # Called with the lock held
+    def save(self):
+        atomic_write(self.index_path, json.dumps(self.last_used))
@@ -0,0 +1,128 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import threading
+import time
+
+import xbmc
+
+from .catalog import load_catalog
+from .commonatv import addon_profile, atomic_write, load_json
+
+# Current rung, measured throughput and the last decisions of the adaptive quality, stored in the addon profile
+quality_state_path = os.path.join(addon_profile, "quality.json")
+
+# Rough average bitrate of Apple's renditions, in bits per second
+nominal_bitrates = {
+    "url-4K-HDR": 40000000,
+    "url-4K-SDR": 35000000,
+    "url-1080-HDR": 15000000,
+    "url-1080-SDR": 12000000,
+    "url-1080-H264": 10000000,
+}
+# A clip taking longer than this many seconds to start, or a clip that fails, moves one rung down the ladder
+startup_delay_limit = 5
+# Clips in a row that must start in time before moving one rung up
+good_starts_to_step_up = 3
+# Measured throughput needed to play a rendition, as a multiple of its bitrate
+throughput_headroom = 1.5
+# Weight of the latest throughput sample in the running average
+throughput_weight = 0.3
+# Decisions kept in the state file for later inspection
+decisions_kept = 100
+
+
+class AdaptiveQuality:
+    # Picks the rendition of each streamed clip from the ranked URL keys of the settings (the ladder).
+    # It starts from the rung reached in the last session, steps down when clips are slow to start, fail or
+    # the measured throughput can't sustain the current rendition, and steps back up after a run of clips
+    # that started in time with enough throughput for the rendition above
+
+    def __init__(self, block_key_list, state_path=quality_state_path):
+        self.ladder = list(block_key_list)
+        self.state_path = state_path
+        self.catalog = None
+        self.lock = threading.Lock()
+        self.rung = 0
+        self.throughput = None
+        self.good_starts = 0
+        self.decisions = []
+        state = load_json(self.state_path, {})
+        # A rung of another ladder doesn't mean anything
+        if state.get("ladder") == self.ladder:
+            self.rung = state.get("rung", 0)
+            self.throughput = state.get("throughput")
+        self.decisions = state.get("decisions", [])
+
+    # The URL of video in the rendition of the current rung, or the best one below it the clip has.
+    # Anything that isn't a streamed Apple clip is returned as is
+    def rendition_for(self, video):
+        if not video.startswith("http"):
+            return video
+        if self.catalog is None:
+            self.catalog = load_catalog()
+        asset = self.catalog.asset_for_file(video.split("/")[-1]) if self.catalog else None
+        if asset is None:
+            return video
+        return asset.url_for(self.ladder[self.rung:]) or video
+
+    # Seconds the clip at url took to start playing
+    def record_startup(self, url, delay):
+        if not url.startswith("http"):
+            return
+        with self.lock:
+            if delay > startup_delay_limit:
+                self._step(1, f"{url.split('/')[-1]} took {delay:.1f}s to start")
+                return
+            self.good_starts += 1
+            if self.good_starts < good_starts_to_step_up or self.rung == 0:
+                return
+            # Without throughput samples (nothing is prefetched), clips starting in time is all we have to go by
+            if self.throughput is None or \
+                    self.throughput >= nominal_bitrates[self.ladder[self.rung - 1]] * throughput_headroom:
+                self._step(-1, f"{self.good_starts} clips in a row started in time")
+
+    def record_failure(self, url):
+        if not url.startswith("http"):
+            return
+        with self.lock:
+            self._step(1, f"{url.split('/')[-1]} failed to play")
+
+    # A download from Apple of size bytes took seconds
+    def record_throughput(self, size, seconds):
+        if seconds <= 0:
+            return
+        sample = size * 8 / seconds
+        with self.lock:
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput = throughput_weight * sample + (1 - throughput_weight) * self.throughput
+            if self.throughput < nominal_bitrates[self.ladder[self.rung]] * throughput_headroom:
+                self._step(1, f"throughput dropped to {self.throughput / 1000000:.1f} Mbit/s")
+            else:
+                self.save()
+
+    # Called with the lock held: move direction rungs down the ladder (up if negative) and record why
+    def _step(self, direction, reason):
+        self.good_starts = 0
+        rung = min(max(self.rung + direction, 0), len(self.ladder) - 1)
+        if rung != self.rung:
+            xbmc.log(f"[Aerial Screensaver] Quality {self.ladder[self.rung]} -> {self.ladder[rung]}: {reason}",
+                     level=xbmc.LOGINFO)
+            self.decisions = (self.decisions + [{"time": int(time.time()), "from": self.ladder[self.rung],
+                                                 "to": self.ladder[rung], "reason": reason}])[-decisions_kept:]
+            self.rung = rung
+        self.save()
+
+    # Called with the lock held
+    def save(self):
+        atomic_write(self.state_path, json.dumps({"ladder": self.ladder, "rung": self.rung,
+                                                  "throughput": self.throughput, "decisions": self.decisions}))
@@ -10,6 +10,7 @@ import xbmc
 import xbmcgui
 
 from .commonatv import translate, addon, addon_path, notification
+from .settings import get_settings
 from .trans import ScreensaverTrans
 
 
@@ -48,10 +49,11 @@ class ScreensaverPreview(xbmcgui.WindowXMLDialog):
 def run():
     if not xbmc.getCondVisibility("Player.HasMedia"):
         if not addon.getSettingBool("is_locked"):
-            if addon.getSettingBool("show-notifications"):
+            settings = get_settings()
+            if settings.show_notifications:
                 notification(translate(32000), translate(32017))
 
-            if addon.getSettingBool("show-previewwindow"):
+            if settings.show_previewwindow:
                 # Start window
                 screensaver = ScreensaverPreview(
                     'screensaver-atv4.xml',
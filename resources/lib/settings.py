@@ -0,0 +1,104 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import xbmc
+
+from .commonatv import addon, compute_block_key_list
+
+# Each unique "accessibilityLabel" in entries.json that has an enable-<location> toggle in settings.xml
+known_locations = sorted(["Africa and the Middle East", "Africa Night", "Alaskan Jellies", "Antarctica",
+                          "Atlantic Ocean to Spain and France", "Australia", "Barracuda", "Bumpheads",
+                          "California Dolphins", "California Kelp Forest", "California to Vegas", "Caribbean Day",
+                          "Caribbean", "China", "Costa Rica Dolphins", "Cownose Rays", "Dubai", "Grand Canyon",
+                          "Gray Reef Sharks", "Greenland", "Hawaii", "Hong Kong", "Humpback Whale", "Iceland",
+                          "Iran and Afghanistan", "Ireland to Asia", "Italy to Asia", "Jacks", "Kelp",
+                          "Korea and Japan Night", "Liwa", "London", "Los Angeles", "New York Night", "New York",
+                          "New Zealand", "Nile Delta", "North America Aurora", "Palau Coral", "Palau Jellies",
+                          "Patagonia", "Red Sea Coral", "Sahara and Italy", "San Francisco", "Scotland",
+                          "Sea Stars", "Seals", "South Africa to North Asia", "Southern California to Baja",
+                          "Tahiti Waves", "West Africa to the Alps", "Yosemite"])
+
+
+# Get the corresponding setting id by adding "enable-" + lowercase + no whitespace
+def location_setting_id(location):
+    return "enable-" + location.lower().replace(" ", "")
+
+
+class SettingsSnapshot:
+    # Every setting the addon reads, fetched from Kodi in a single pass. Derived values (URL key ranking,
+    # enabled locations) are computed here once instead of by every consumer
+
+    def __init__(self):
+        self.enable_4k = addon.getSettingBool("enable-4k")
+        self.enable_hdr = addon.getSettingBool("enable-hdr")
+        self.enable_hevc = addon.getSettingBool("enable-hevc")
+        self.show_notifications = addon.getSettingBool("show-notifications")
+        self.show_previewwindow = addon.getSettingBool("show-previewwindow")
+        self.check_dpms = addon.getSettingInt("check-dpms")
+        self.dpms_action = addon.getSettingInt("dpms-action")
+        self.manual_dpms = addon.getSettingInt("manual-dpms")
+        self.toggle_displayoff = addon.getSettingBool("toggle-displayoff")
+        self.toggle_cecoff = addon.getSettingBool("toggle-cecoff")
+        self.download_folder = addon.getSetting("download-folder")
+        self.force_offline = addon.getSettingBool("force-offline")
+        self.get_videos_from_apple = addon.getSettingBool("get-videos-from-apple")
+        self.feed_refresh_hours = addon.getSettingInt("feed-refresh-hours")
+        self.random_seek_local = addon.getSettingBool("random-seek-local")
+        self.start_at_poi = addon.getSettingBool("start-at-poi")
+        self.enable_checksums = addon.getSettingBool("enable-checksums")
+        self.deep_verify = addon.getSettingBool("deep-verify")
+        self.download_connections = max(1, addon.getSettingInt("download-connections"))
+        self.download_budget_gb = addon.getSettingInt("download-budget")
+        # 0: smallest first, 1: most played first, 2: catalog order
+        self.download_order = addon.getSettingInt("download-order")
+        self.prefetch_clips = addon.getSettingInt("prefetch-clips")
+        self.prefetch_cache_mb = addon.getSettingInt("prefetch-cache-size")
+        self.prefer_local_clips = addon.getSettingBool("prefer-local-clips")
+        self.adaptive_quality = addon.getSettingBool("adaptive-quality")
+        self.enable_telemetry = addon.getSettingBool("enable-telemetry")
+        self.extra_local_folder = addon.getSetting("extra-local-folder")
+        self.only_extra_local_folder = addon.getSettingBool("only-extra-local-folder")
+
+        # Parse the H264, HDR, and 4K settings to determine URL preference.
+        self.block_key_list = compute_block_key_list(self.enable_4k, self.enable_hdr, self.enable_hevc)
+        # 0: every scene, 1: day scenes only, 2: night scenes only, 3: follow the time of day
+        self.time_of_day = addon.getSettingInt("time-of-day")
+        self.disabled_locations = frozenset(location for location in known_locations
+                                            if not addon.getSettingBool(location_setting_id(location)))
+
+    # Locations without a matching setting stay in the rotation, as nothing can disable them
+    def location_enabled(self, location):
+        return location not in self.disabled_locations
+
+    # Everything the playlist is computed from, to tell whether a settings change affects it
+    def playlist_key(self):
+        return (tuple(self.block_key_list), self.disabled_locations, self.time_of_day, self.force_offline,
+                self.get_videos_from_apple, self.download_folder, self.extra_local_folder,
+                self.only_extra_local_folder)
+
+
+_snapshot = None
+
+
+def get_settings():
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = SettingsSnapshot()
+    return _snapshot
+
+
+def invalidate_settings():
+    global _snapshot
+    _snapshot = None
+
+
+class SettingsMonitor(xbmc.Monitor):
+    # Drops the snapshot whenever the user changes a setting, the next read fetches them again
+
+    def onSettingsChanged(self):
+        invalidate_settings()
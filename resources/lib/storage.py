@@ -0,0 +1,228 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import bisect
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import xbmc
+import xbmcvfs
+
+from .commonatv import addon_path, load_json
+from .downloader import part_marker, probe_url, segment_min_size
+
+# Sizes of the videos from the last report of entrychecksumgenerator.py, {file name: bytes}
+video_sizes_path = os.path.join(addon_path, "resources", "sizes.json")
+# HEAD requests sent at once for the sizes the report doesn't have
+size_probe_workers = 8
+
+
+class StoragePlan:
+    __slots__ = ("downloads", "unknown", "evictions", "replacements", "skipped", "stale_parts", "projected_size")
+
+    def __init__(self):
+        # [(url, bytes)] of the videos to download, without the ones already complete in the download folder
+        self.downloads = []
+        # Videos to download whose size neither the report nor the server gives, they count as 0 bytes
+        self.unknown = 0
+        # [(file name, bytes)] of the downloaded videos to remove to make room, least valuable first
+        self.evictions = []
+        # {file name: URLs} of the evicted videos a better rendition of the same scene among the downloads replaces
+        self.replacements = {}
+        # URLs left out because they don't fit in the budget
+        self.skipped = set()
+        # {file name: bytes} of the parts left by unfinished downloads of videos the plan doesn't download
+        self.stale_parts = {}
+        # Bytes the videos of the download folder will take once the plan is carried out
+        self.projected_size = 0
+
+    def download_size(self):
+        return sum(size for _, size in self.downloads)
+
+    def eviction_size(self):
+        return sum(size for _, size in self.evictions)
+
+
+class StorageManager:
+    # Keeps the videos of the download folder under budget bytes (0 for no limit). When a download doesn't fit,
+    # the least valuable videos make room, whether already downloaded or about to be: renditions the quality
+    # settings don't want anymore first, then those a better rendition of the same scene replaces, then the least
+    # played, then the lowest ranked in block_key_list, or in the list of location_key_lists for the location of
+    # the scene. Files that aren't videos of the catalog are never touched
+
+    def __init__(self, download_folder, budget, block_key_list, catalog, history=None, sizes=None,
+                 location_key_lists=None):
+        self.download_folder = download_folder
+        self.budget = budget
+        self.block_key_list = block_key_list
+        self.catalog = catalog
+        self.history = history
+        self.sizes = load_json(video_sizes_path, {}) if sizes is None else sizes
+        self.location_key_lists = location_key_lists or {}
+        # URLs whose server didn't give a size, so they aren't asked again
+        self.unprobed = set()
+
+    def _key_list(self, asset):
+        return self.location_key_lists.get(asset.location, self.block_key_list)
+
+    # Position of the rendition in the ranked URL keys, past the end for renditions the settings don't allow
+    def _rank(self, asset, file_name):
+        key_list = self._key_list(asset)
+        for key, url in asset.urls.items():
+            if url.endswith("/" + file_name) and key in key_list:
+                return key_list.index(key)
+        return len(key_list)
+
+    # {file name: bytes} of the catalog videos in the download folder
+    def downloaded_videos(self):
+        videos = {}
+        for file_name in xbmcvfs.listdir(self.download_folder)[1]:
+            if self.catalog.asset_for_file(file_name) is not None:
+                videos[file_name] = xbmcvfs.Stat(os.path.join(self.download_folder, file_name)).st_size()
+        return videos
+
+    # (part file name, video file name) of the parts left by unfinished downloads of catalog videos
+    def _part_files(self):
+        for part_name in xbmcvfs.listdir(self.download_folder)[1]:
+            file_name, marker, offset = part_name.rpartition(part_marker)
+            if marker and offset.isdigit() and self.catalog.asset_for_file(file_name) is not None:
+                yield part_name, file_name
+
+    # {file name: bytes of its parts} of the unfinished downloads of catalog videos
+    def partial_downloads(self):
+        parts = {}
+        for part_name, file_name in self._part_files():
+            parts[file_name] = parts.get(file_name, 0) + xbmcvfs.Stat(
+                os.path.join(self.download_folder, part_name)).st_size()
+        return parts
+
+    # Ask the server for the sizes of the videos missing from the report, e.g. without a sizes.json or for
+    # videos added to the feed since it was generated
+    def probe_sizes(self, urls):
+        missing = [url for url in urls if url.split("/")[-1] not in self.sizes and url not in self.unprobed]
+        if not missing:
+            return
+
+        def probe(url):
+            try:
+                return probe_url(url)[0]
+            except Exception as e:
+                xbmc.log("Could not get the size of {}: {}".format(url, e), level=xbmc.LOGWARNING)
+                return None
+
+        with ThreadPoolExecutor(max_workers=size_probe_workers) as executor:
+            for url, size in zip(missing, executor.map(probe, missing)):
+                if size is None:
+                    self.unprobed.add(url)
+                else:
+                    self.sizes[url.split("/")[-1]] = size
+
+    def plan(self, urls):
+        self.probe_sizes(urls)
+        plan = StoragePlan()
+        downloaded = self.downloaded_videos()
+        partial = self.partial_downloads()
+        requested = {}
+        for url in urls:
+            file_name = url.split("/")[-1]
+            size = self.sizes.get(file_name)
+            requested[file_name] = url
+            # Complete already, the downloader only verifies it
+            if file_name in downloaded and (size is None or downloaded[file_name] == size):
+                continue
+            plan.downloads.append((url, size or 0))
+            if size is None:
+                plan.unknown += 1
+
+        # Best rank of each scene among the videos that will be in the folder, to find the replaced renditions
+        best_rank = {}
+        for file_name in list(downloaded) + list(requested):
+            asset = self.catalog.asset_for_file(file_name)
+            if asset is not None:
+                best_rank[id(asset)] = min(best_rank.get(id(asset), len(self._key_list(asset))),
+                                           self._rank(asset, file_name))
+
+        def value(file_name, is_download):
+            asset = self.catalog.asset_for_file(file_name)
+            rank = self._rank(asset, file_name) if asset is not None else 0
+            wanted = asset is None or rank < len(self._key_list(asset))
+            replaced = asset is not None and best_rank[id(asset)] < rank
+            play_count = self.history.play_count(file_name) if self.history else 0
+            return wanted, not replaced, play_count, is_download, -rank
+
+        # Joining the parts of a split or resumed download takes its size a second time until the parts are deleted
+        def join_size():
+            return max((size for url, size in plan.downloads if url not in plan.skipped and (
+                size >= 2 * segment_min_size or url.split("/")[-1] in partial)), default=0)
+
+        # Parts of the downloads are counted in their size
+        total = sum(downloaded.values()) + plan.download_size()
+        if self.budget and total + join_size() > self.budget:
+            # Requested videos already downloaded stay, the user asked for them
+            candidates = [(value(file_name, False), file_name, size, None) for file_name, size in downloaded.items()
+                          if file_name not in requested]
+            candidates += [(value(url.split("/")[-1], True), url.split("/")[-1], size, url)
+                           for url, size in plan.downloads]
+            # By value, then file name, which is unique
+            candidates.sort()
+            while candidates and total + join_size() > self.budget:
+                _, file_name, size, url = candidates.pop(0)
+                if url is None:
+                    plan.evictions.append((file_name, size))
+                    total -= size
+                    continue
+                plan.skipped.add(url)
+                total -= size
+                # Without this download, the wanted renditions it would have replaced may be all the scene has
+                # left. Unless another requested rendition of the scene remains, they are no longer replaced and
+                # go back among the candidates with their own value
+                asset = self.catalog.asset_for_file(file_name)
+                if any(self.catalog.asset_for_file(other) is asset and other_url not in plan.skipped
+                       for other, other_url in requested.items()):
+                    continue
+                for evicted_name, evicted_size in list(plan.evictions):
+                    evicted_value = value(evicted_name, False)
+                    if self.catalog.asset_for_file(evicted_name) is asset and evicted_value[0]:
+                        plan.evictions.remove((evicted_name, evicted_size))
+                        total += evicted_size
+                        bisect.insort(candidates, ((True, True) + evicted_value[2:], evicted_name, evicted_size, None))
+            plan.downloads = [(url, size) for url, size in plan.downloads if url not in plan.skipped]
+        for file_name, _ in plan.evictions:
+            asset = self.catalog.asset_for_file(file_name)
+            rank = self._rank(asset, file_name)
+            replacements = {url for url, _ in plan.downloads
+                            if self.catalog.asset_for_file(url.split("/")[-1]) is asset
+                            and self._rank(asset, url.split("/")[-1]) < rank}
+            if replacements:
+                plan.replacements[file_name] = replacements
+        downloading = {url.split("/")[-1] for url, _ in plan.downloads}
+        plan.stale_parts = {file_name: size for file_name, size in partial.items() if file_name not in downloading}
+        plan.projected_size = total
+        return plan
+
+    # Remove the parts the plan won't resume and the videos it evicts once its downloads are over, given the URLs
+    # the downloader completed. A replaced rendition goes only if one of its replacements is complete, so a failed
+    # or canceled download never leaves a scene without its video. The others go while the folder, with the parts
+    # kept for a later resume, is over budget with what was actually downloaded
+    def apply(self, plan, completed):
+        for part_name, file_name in list(self._part_files()):
+            if file_name in plan.stale_parts:
+                xbmc.log("Removing {}, its video is no longer downloaded".format(part_name), level=xbmc.LOGINFO)
+                xbmcvfs.delete(os.path.join(self.download_folder, part_name))
+        total = sum(self.downloaded_videos().values()) + sum(self.partial_downloads().values())
+        for file_name, size in plan.evictions:
+            replacements = plan.replacements.get(file_name)
+            if replacements:
+                if not replacements & completed:
+                    continue
+            elif not (self.budget and total > self.budget):
+                continue
+            total -= size
+            xbmc.log("Removing {} ({} MB) to stay within the download folder size limit".format(
+                file_name, size // 1000 // 1000), level=xbmc.LOGINFO)
+            xbmcvfs.delete(os.path.join(self.download_folder, file_name))
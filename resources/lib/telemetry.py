@@ -0,0 +1,90 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .commonatv import addon_profile, atomic_write, load_json
+from .settings import get_settings
+
+# Measurements of the last sessions, stored in the addon profile when the enable-telemetry setting is on
+telemetry_path = os.path.join(addon_profile, "telemetry.json")
+# Sessions kept in telemetry.json, older ones are dropped
+sessions_kept = 50
+
+_lock = threading.Lock()
+_session_started = time.time()
+# {name: count}
+_counters = {}
+# {name: [samples, total, min, max, last]}, for durations in seconds and other measured values
+_measures = {}
+
+
+def enabled():
+    return get_settings().enable_telemetry
+
+
+def count(name, amount=1):
+    if not enabled():
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def measure(name, value):
+    if not enabled():
+        return
+    with _lock:
+        entry = _measures.get(name)
+        if entry is None:
+            _measures[name] = [1, value, value, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            entry[2] = min(entry[2], value)
+            entry[3] = max(entry[3], value)
+            entry[4] = value
+
+
+# Measure how long the block takes, in seconds
+@contextmanager
+def timer(name):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        measure(name, time.time() - start_time)
+
+
+# Append what was measured since the last flush to telemetry.json as a session of process
+# (screensaver, service or downloader), and start a new session
+def flush(process):
+    global _session_started
+    if not enabled():
+        return
+    with _lock:
+        if not _counters and not _measures:
+            return
+        session = {
+            "process": process,
+            "started": int(_session_started),
+            "ended": int(time.time()),
+            "counters": dict(_counters),
+            "measures": {name: {"samples": samples, "total": total, "mean": total / samples, "min": low,
+                                "max": high, "last": last}
+                         for name, (samples, total, low, high, last) in _measures.items()},
+        }
+        _counters.clear()
+        _measures.clear()
+        _session_started = time.time()
+
+        sessions = (load_json(telemetry_path, []) + [session])[-sessions_kept:]
+        atomic_write(telemetry_path, json.dumps(sessions, indent=1))
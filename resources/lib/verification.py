@@ -0,0 +1,61 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import json
+import os
+import threading
+
+import xbmcvfs
+
+from .commonatv import addon_profile, atomic_write, load_json
+
+# Index of the downloaded files whose checksum already matched, stored in the addon profile
+verification_index_path = os.path.join(addon_profile, "verified.json")
+
+
+class VerificationIndex:
+    # Remembers (size, mtime, checksum) of verified files so unchanged ones are not hashed again
+
+    def __init__(self, index_path=verification_index_path):
+        self.index_path = index_path
+        self.entries = load_json(self.index_path, {})
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _stat(path):
+        stat = xbmcvfs.Stat(xbmcvfs.translatePath(path))
+        return stat.st_size(), stat.st_mtime()
+
+    # True when the file still has the size and mtime it had when it was verified against checksum
+    def is_verified(self, path, checksum):
+        with self.lock:
+            entry = self.entries.get(path)
+        if not entry or entry[2] != checksum:
+            return False
+        try:
+            return list(self._stat(path)) == entry[:2]
+        except Exception:
+            return False
+
+    def record(self, path, checksum):
+        size, mtime = self._stat(path)
+        with self.lock:
+            self.entries[path] = [size, mtime, checksum]
+
+    # Forget a single file, or every file when no path is given
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.entries = {}
+            else:
+                self.entries.pop(path, None)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        atomic_write(self.index_path, data)
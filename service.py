@@ -6,7 +6,11 @@
    See LICENSE for more information.
 """
 
+from resources.lib.background import BackgroundService
 from resources.lib.commonatv import addon
 
 # set locked setting back to false on startup just in case kodi had crashed during playback
 addon.setSettingBool("is_locked", False)
+
+# Keep the feed and the playlist snapshot up to date for as long as Kodi runs
+BackgroundService().run()
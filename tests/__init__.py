@@ -0,0 +1,25 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+# The tests run outside Kodi with the stand-ins of the benchmarks: python3 -m pytest tests
+# (or python3 -m unittest discover tests). Importing the package sets them up before any addon module loads
+
+import os
+import sys
+import tempfile
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+repository_path = os.path.dirname(tests_path)
+sys.path[:0] = [os.path.join(repository_path, "benchmarks", "stubs"), os.path.join(repository_path, "benchmarks"),
+                repository_path]
+
+import xbmcaddon  # noqa: E402
+
+# The addon modules resolve the profile folder when they are imported
+profile_path = tempfile.mkdtemp(prefix="atv4-tests-")
+xbmcaddon.addon_info["profile"] = profile_path
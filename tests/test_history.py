@@ -0,0 +1,42 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import os
+import unittest
+
+import synthetic
+from resources.lib.catalog import Catalog
+from resources.lib.history import PlayHistory
+
+from . import profile_path
+
+
+class PlayHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = Catalog(synthetic.entries_json(2, "http://apple", ["Synthetic"]))
+        self.url = self.catalog.assets[0].urls["url-1080-SDR"]
+        self.file_name = self.url.split("/")[-1]
+        self.history = PlayHistory(os.path.join(profile_path, "history.json"), catalog=self.catalog)
+        self.history.reset()
+
+    # An Apple clip played streamed is played in any other form, and the round forgets it in any form
+    def test_apple_clip_is_the_same_streamed_or_downloaded(self):
+        self.history.mark_played(self.url)
+        self.assertTrue(self.history.is_played(os.path.join("C:\\", "Aerials", self.file_name)))
+        self.assertTrue(self.history.is_played("/storage/aerials/" + self.file_name))
+        self.history.mark_played("/storage/aerials/" + self.file_name)
+        self.assertEqual(len(self.history.played), 1)
+        self.assertEqual(self.history.play_count(self.file_name), 2)
+        self.history.reset(["/storage/aerials/" + self.file_name])
+        self.assertFalse(self.history.is_played(self.url))
+
+    # Other local files may share a file name in different folders, they are told apart by path
+    def test_local_files_are_known_by_path(self):
+        self.history.mark_played("/storage/videos/a/clip.mov")
+        self.assertFalse(self.history.is_played("/storage/videos/b/clip.mov"))
@@ -0,0 +1,48 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import os
+import random
+import unittest
+
+from resources.lib import playlist
+from resources.lib.history import PlayHistory
+from resources.lib.playlist import ShuffledPlaylist
+
+from . import profile_path
+
+
+class ShuffledPlaylistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history_path = os.path.join(profile_path, "history.json")
+        if os.path.exists(self.history_path):
+            os.remove(self.history_path)
+
+    def tearDown(self):
+        playlist.randrange = random.randrange
+
+    def first_round(self, seed, played, prefer):
+        playlist.randrange = random.Random(seed).randrange
+        videos = ["http://apple/video{}.mov".format(index) for index in range(8)]
+        history = PlayHistory(self.history_path)
+        history.reset()
+        for video in played:
+            history.mark_played(video)
+        shuffled = ShuffledPlaylist(videos)
+        shuffled.use_history(history, prefer=prefer)
+        unplayed = [video for video in videos if video not in played]
+        return [shuffled.next_video() for _ in unplayed], unplayed
+
+    # The rest of a round started in an earlier session plays every clip not played yet, each once
+    def test_first_round_covers_every_clip_not_played(self):
+        for prefer in (None, lambda video: video.endswith(("1.mov", "4.mov", "6.mov"))):
+            for seed in range(300):
+                picks, unplayed = self.first_round(seed, ["http://apple/video{}.mov".format(index)
+                                                          for index in (0, 3, 5)], prefer)
+                self.assertCountEqual(picks, unplayed, "seed {}".format(seed))
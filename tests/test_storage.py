@@ -0,0 +1,48 @@
+"""
+   Copyright (C) 2015- enen92
+   This file is part of screensaver.atv4 - https://github.com/enen92/screensaver.atv4
+
+   SPDX-License-Identifier: GPL-2.0-only
+   See LICENSE for more information.
+"""
+
+import os
+import tempfile
+import unittest
+
+import synthetic
+from resources.lib.catalog import Catalog
+from resources.lib.storage import StorageManager
+
+
+class StorageManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = Catalog(synthetic.entries_json(1, "http://apple", ["Synthetic"]))
+        urls = self.catalog.assets[0].urls
+        self.old_name = urls["url-1080-SDR"].split("/")[-1]
+        self.new_url = urls["url-4K-SDR"]
+        self.download_folder = tempfile.mkdtemp(prefix="atv4-downloads-")
+        with open(os.path.join(self.download_folder, self.old_name), "wb") as f:
+            f.write(b"\0" * 100)
+        # Only room for one rendition of the scene
+        self.storage = StorageManager(self.download_folder, 250, ["url-4K-SDR", "url-1080-SDR"], self.catalog,
+                                      sizes={self.new_url.split("/")[-1]: 200})
+        self.plan = self.storage.plan([self.new_url])
+
+    def test_replaced_rendition_stays_until_its_replacement_is_complete(self):
+        self.assertEqual(self.plan.evictions, [(self.old_name, 100)])
+        self.storage.apply(self.plan, set())
+        self.assertTrue(os.path.exists(os.path.join(self.download_folder, self.old_name)))
+        self.storage.apply(self.plan, {self.new_url})
+        self.assertFalse(os.path.exists(os.path.join(self.download_folder, self.old_name)))
+
+    # Parts of a video that is no longer downloaded count against the budget until they are removed
+    def test_stale_parts_are_counted_and_removed(self):
+        part_path = os.path.join(self.download_folder, self.old_name + ".part.0")
+        os.rename(os.path.join(self.download_folder, self.old_name), part_path)
+        self.assertEqual(self.storage.partial_downloads(), {self.old_name: 100})
+        plan = self.storage.plan([self.new_url])
+        self.assertEqual(plan.stale_parts, {self.old_name: 100})
+        self.storage.apply(plan, set())
+        self.assertFalse(os.path.exists(part_path))